@@ -0,0 +1,412 @@
+#!/usr/bin/env python3
+"""
+Offline benchmark for the CLI client's stream handling.
+
+Starts a local mock of the /api/chat endpoint that replays synthetic or
+recorded event streams, runs them through the client's real streaming path
+(process_streaming_response, StreamRenderer, format_tool_result) with output
+going to a null terminal, and reports client-side throughput, render cost
+and peak memory per scenario.
+
+    python benchmark.py                          # all scenarios
+    python benchmark.py --scenario long-reply --scale 4
+    python benchmark.py --replay session.jsonl   # replay a recorded stream
+    python benchmark.py --record session.jsonl --url http://localhost:5001/api/chat --prompt "List files"
+"""
+import argparse
+import gzip
+import importlib.util
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def load_client():
+    """Import cli-client.py as a module (its file name is not importable directly)"""
+    spec = importlib.util.spec_from_file_location("cli_client", os.path.join(HERE, "cli-client.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+# ---------------------------------------------------------------------------
+# Synthetic event streams
+
+LOREM = ("The agent inspected the repository layout, read the configuration and "
+         "summarised the findings below. ")
+CODE = "def handler(event):\n    result = process(event)\n    return {'status': 'ok', 'result': result}\n"
+
+def reply_text(chars):
+    """Markdown resembling a real answer: paragraphs, lists and code fences"""
+    blocks = []
+    size = 0
+    i = 0
+    while size < chars:
+        i += 1
+        if i % 5 == 0:
+            block = f"```python\n{CODE * 3}```"
+        elif i % 3 == 0:
+            block = "\n".join(f"- item {i}.{n}: {LOREM[:60]}" for n in range(4))
+        else:
+            block = LOREM * 4
+        blocks.append(block)
+        size += len(block) + 2
+    return "\n\n".join(blocks)[:chars]
+
+def assistant_events(chars, chunk_size=6):
+    text = reply_text(chars)
+    events = [{"role": "assistant", "content": text[i:i + chunk_size], "type": "chunk"}
+              for i in range(0, len(text), chunk_size)]
+    events.append({"role": "assistant", "content": "", "type": "done"})
+    return events
+
+def tool_event(size):
+    body = json.dumps({"path": "/srv/app", "entries": ["file_%d.py" % n for n in range(max(1, size // 14))]})
+    return {"role": "tool_call", "content": "Tool result: " + body[:max(size, 32)]}
+
+def history_messages(count, chars):
+    messages = []
+    for i in range(count):
+        role = "user" if i % 2 == 0 else "assistant"
+        messages.append({"role": role, "content": (LOREM * (chars // len(LOREM) + 1))[:chars]})
+    return messages
+
+def scenario_long_reply(scale):
+    return assistant_events(int(60000 * scale)), []
+
+def scenario_many_tool_calls(scale):
+    events = []
+    for _ in range(int(200 * scale)):
+        events += assistant_events(120)
+        events.append(tool_event(400))
+    events += assistant_events(600)
+    return events, []
+
+def scenario_huge_tool_result(scale):
+    events = assistant_events(300) + [tool_event(int(8 * 1024 * 1024 * scale))] + assistant_events(300)
+    return events, []
+
+def scenario_deep_history(scale):
+    return assistant_events(2000), history_messages(int(4000 * scale), 2000)
+
+SCENARIOS = {
+    "long-reply": ("One long markdown answer streamed in small chunks", scenario_long_reply),
+    "many-tool-calls": ("An agentic run alternating short replies and tool results", scenario_many_tool_calls),
+    "huge-tool-result": ("A single multi-megabyte tool result", scenario_huge_tool_result),
+    "deep-history": ("A short reply to a request carrying a long conversation", scenario_deep_history),
+}
+
+def read_recording(path):
+    """Events (and their recorded delays) from a file written by --record"""
+    events = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                events.append(json.loads(line))
+    return events
+
+# ---------------------------------------------------------------------------
+# Mock endpoint
+
+class MockChatServer:
+    """
+    Local stand-in for the /api/chat endpoint.
+
+    Every POST is answered with the configured event stream as a chunked
+    response, one event per chunk. `rate` caps events per second (0 streams
+    as fast as possible); recorded events carrying "_delay" replay with
+    their original timing when `realtime` is set.
+
+    Compressed (gzip) and chunked request bodies are accepted; set
+    `accept_encoding` to advertise request codings in every response.
+
+    With `delta` set it also plays the server side of the client's delta
+    request protocol: it keeps each session's messages, answers 409 to a
+    delta whose base it does not hold, and acknowledges stored prefixes.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, delta=False, fingerprints=None, accept_encoding=None):
+        self.delta = delta
+        self.accept_encoding = accept_encoding  # Request codings advertised to the client (RFC 7694)
+        self.fingerprints = fingerprints  # cli.prefix_fingerprints
+        self.sessions = {}  # session id -> (messages, prefix fingerprints)
+        self.lock = threading.Lock()
+        self.events = []
+        self.rate = 0.0
+        self.realtime = False
+        self.requests = 0
+        self.request_bytes = 0
+        self.httpd = ThreadingHTTPServer((host, port), _MockChatHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.mock = self
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/api/chat"
+
+    def set_stream(self, events, rate=0.0, realtime=False):
+        self.events = events
+        self.rate = rate
+        self.realtime = realtime
+        # Pre-encode so the server side costs as little as possible during a run
+        self.encoded = []
+        for event in events:
+            data = (json.dumps({k: v for k, v in event.items() if k != "_delay"}) + "\n").encode("utf-8")
+            self.encoded.append((event.get("_delay", 0.0), b"%x\r\n%s\r\n" % (len(data), data)))
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+class _MockChatHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self):
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            parts = []
+            while True:
+                size = int(self.rfile.readline().split(b";")[0].strip() or b"0", 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                parts.append(self.rfile.read(size))
+                self.rfile.readline()
+            return b"".join(parts)
+        return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+    def decode_body(self, body):
+        encoding = self.headers.get("Content-Encoding", "").lower()
+        if encoding == "gzip":
+            return gzip.decompress(body)
+        if encoding == "zstd":
+            import zstandard
+            return zstandard.ZstdDecompressor().decompressobj().decompress(body)
+        return body
+
+    def apply_delta(self, body):
+        """Server side of the delta protocol; returns (status, ack header value)"""
+        mock = self.server.mock
+        request = json.loads(body)
+        session_id = request.get("session_id")
+        if not session_id:
+            return 200, None
+        with mock.lock:
+            messages, fingerprints = mock.sessions.get(session_id, ([], []))
+            base = request.get("base")
+            if base:
+                count = base["count"]
+                if count > len(fingerprints) or fingerprints[count - 1] != base["hash"]:
+                    return 409, None
+                messages = messages[:count] + request["messages"]
+            else:
+                messages = request["messages"]
+            fingerprints = mock.fingerprints(messages)
+            if request["prefix"]["hash"] != (fingerprints[-1] if fingerprints else ""):
+                return 409, None
+            mock.sessions[session_id] = (messages, fingerprints)
+        return 200, request["prefix"]["hash"]
+
+    def do_POST(self):
+        mock = self.server.mock
+        body = self.read_body()
+        mock.requests += 1
+        mock.request_bytes += len(body)
+
+        ack = None
+        if mock.delta:
+            status, ack = self.apply_delta(self.decode_body(body))
+            if status != 200:
+                self.send_response(status)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+
+        self.send_response(200)
+        if mock.accept_encoding:
+            self.send_header("Accept-Encoding", mock.accept_encoding)
+        if ack:
+            self.send_header("X-Prefix-Ack", ack)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        interval = 1.0 / mock.rate if mock.rate else 0.0
+        try:
+            for delay, chunk in mock.encoded:
+                if mock.realtime and delay:
+                    time.sleep(delay)
+                elif interval:
+                    time.sleep(interval)
+                self.wfile.write(chunk)
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+# ---------------------------------------------------------------------------
+# Runner
+
+def run_once(cli, server, history):
+    """Stream one turn through the client; returns (seconds, turn metrics summary, messages after the turn)"""
+    cli.conversation_history = []
+    messages = history + [{"role": "user", "content": "benchmark"}]
+    started = time.perf_counter()
+    cli.process_streaming_response(server.url, messages, 0.0, 8000)
+    elapsed = time.perf_counter() - started
+    return elapsed, (cli.turn_metrics[-1] if cli.turn_metrics else {}), messages + cli.conversation_history
+
+def run_scenario(cli, server, name, events, history, args):
+    server.set_stream(events, rate=args.rate, realtime=args.realtime)
+    # Each scenario starts from a fresh render policy, so one cannot switch the next to plain text
+    cli.render_policy = cli.RenderPolicy(args.render)
+    stream_bytes = sum(len(chunk) for _, chunk in server.encoded)
+    history_messages = len(history)
+
+    timings = []
+    summary = {}
+    for _ in range(args.repeat):
+        sent = server.request_bytes
+        elapsed, summary, messages = run_once(cli, server, history)
+        timings.append(elapsed)
+        request_bytes = server.request_bytes - sent
+        if args.delta:
+            # Successive turns of one conversation, so each request extends the last one
+            history = messages
+    best = min(timings)
+
+    peak_mb = None
+    if not args.no_memory:
+        tracemalloc.start()
+        run_once(cli, server, history)
+        peak_mb = tracemalloc.get_traced_memory()[1] / 1024 / 1024
+        tracemalloc.stop()
+
+    return {
+        "scenario": name,
+        "events": len(events),
+        "stream_mb": round(stream_bytes / 1024 / 1024, 2),
+        "history_messages": history_messages,
+        "request_kb": round(request_bytes / 1024, 1),
+        "seconds": round(best, 3),
+        "events_per_sec": round(len(events) / best, 1),
+        "mb_per_sec": round(stream_bytes / 1024 / 1024 / best, 2),
+        "ttfb_ms": summary.get("ttfb_ms"),
+        "render_ms": summary.get("render_ms"),
+        "render_share": round(summary.get("render_ms", 0) / 1000 / best, 3) if summary else None,
+        "peak_mb": round(peak_mb, 1) if peak_mb is not None else None,
+    }
+
+def print_results(cli, results):
+    table = cli.Table(title="Client stream benchmark", box=cli.box.SIMPLE)
+    columns = [("Scenario", "scenario"), ("Events", "events"), ("Stream MB", "stream_mb"),
+               ("History", "history_messages"), ("Request KB", "request_kb"), ("Seconds", "seconds"),
+               ("Events/s", "events_per_sec"), ("MB/s", "mb_per_sec"), ("TTFB ms", "ttfb_ms"), ("Render ms", "render_ms"),
+               ("Render share", "render_share"), ("Peak MB", "peak_mb")]
+    for label, _ in columns:
+        table.add_column(label, justify="left" if label == "Scenario" else "right")
+    for result in results:
+        table.add_row(*["-" if result[key] is None else str(result[key]) for _, key in columns])
+    out = cli.Console()
+    out.width = max(out.width, 150)
+    out.print(table)
+
+def record_stream(cli, url, prompt, path):
+    """Capture a real endpoint's event stream, with inter-event delays, for later replay"""
+    transport = cli.get_transport()
+    payload = {"messages": [{"role": "user", "content": prompt}], "temperature": 0.0, "max_output_tokens": 8000}
+    response = transport.post_stream(url, payload)
+    count = 0
+    last = time.perf_counter()
+    with open(path, "w", encoding="utf-8") as f:
+        for line in transport.iter_lines(response):
+            if not line:
+                continue
+            now = time.perf_counter()
+            event = json.loads(line)
+            event["_delay"] = round(now - last, 4)
+            last = now
+            f.write(json.dumps(event) + "\n")
+            count += 1
+    print(f"Recorded {count} events to {path}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark for the Qwen Agentic CLI stream handling")
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS),
+                        help="Scenario to run (repeatable, default: all)")
+    parser.add_argument("--scale", type=float, default=1.0,
+                        help="Multiply every scenario's size (default: 1.0)")
+    parser.add_argument("--rate", type=float, default=0.0,
+                        help="Events per second sent by the mock server (default: 0, unthrottled)")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Timed runs per scenario, best is reported (default: 3)")
+    parser.add_argument("--render", choices=("auto", "live", "plain"), default="auto",
+                        help="Client render mode to benchmark (default: auto)")
+    parser.add_argument("--delta", action="store_true",
+                        help="Use the delta request protocol (the mock server acknowledges prefixes)")
+    parser.add_argument("--compress", choices=("off", "gzip", "zstd"), default="off",
+                        help="Request body compression the mock server advertises (default: off)")
+    parser.add_argument("--no-memory", action="store_true",
+                        help="Skip the extra tracemalloc run used for peak memory")
+    parser.add_argument("--replay", type=str,
+                        help="Replay a recorded event stream instead of the synthetic scenarios")
+    parser.add_argument("--realtime", action="store_true",
+                        help="With --replay, keep the recorded delays between events")
+    parser.add_argument("--record", type=str,
+                        help="Record a stream from --url for --prompt into this file and exit")
+    parser.add_argument("--url", type=str, help="Real endpoint to record from (with --record)")
+    parser.add_argument("--prompt", type=str, default="Hello", help="Prompt to record (with --record)")
+    parser.add_argument("--json", type=str, help="Also write the results as JSON lines to this file")
+    args = parser.parse_args()
+
+    cli = load_client()
+    if args.record:
+        if not args.url:
+            parser.error("--record needs --url")
+        record_stream(cli, args.url, args.prompt, args.record)
+        return
+
+    # Render for real, into a null terminal; large tool results go to a throwaway blob store
+    cli.console = cli.Console(file=open(os.devnull, "w"), force_terminal=True, width=120)
+    blob_dir = tempfile.TemporaryDirectory(prefix="qwen-cli-bench-")
+    cli.BLOB_DIR = blob_dir.name
+    if args.delta:
+        cli.delta_session = cli.DeltaSession()
+    cli.get_transport().compression = "auto"
+    server = MockChatServer(delta=args.delta, fingerprints=cli.prefix_fingerprints,
+                            accept_encoding=None if args.compress == "off" else args.compress).start()
+    try:
+        if args.replay:
+            runs = [(os.path.basename(args.replay), read_recording(args.replay), [])]
+        else:
+            names = args.scenario or list(SCENARIOS)
+            runs = [(name, *SCENARIOS[name][1](args.scale)) for name in names]
+
+        results = []
+        for name, events, history in runs:
+            sys.stderr.write(f"Running {name} ({len(events)} events)...\n")
+            results.append(run_scenario(cli, server, name, events, history, args))
+    finally:
+        server.stop()
+        blob_dir.cleanup()
+
+    print_results(cli, results)
+    if args.json:
+        with open(args.json, "a", encoding="utf-8") as f:
+            for result in results:
+                f.write(json.dumps(result) + "\n")
+
+if __name__ == "__main__":
+    main()
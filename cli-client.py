@@ -1,30 +1,170 @@
 #!/usr/bin/env python3
+import time
+startup_started = time.perf_counter()  # For --profile-startup
 import json
-import requests
 import sys
 import os
 import signal
+import socket
 import threading
 import argparse
 import select
+import re
+import mmap
+import hashlib
+import zlib
+import itertools
+import uuid
+import importlib
+import importlib.util
+from collections import OrderedDict, deque
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlsplit
 from datetime import datetime
 from rich.console import Console
-from rich.markdown import Markdown
-from rich.syntax import Syntax
 from rich.panel import Panel
-from rich.prompt import Prompt
 from rich.padding import Padding
-from rich.live import Live
+from rich.segment import Segment, Segments
+from rich.markup import escape
 from rich.text import Text
-from rich.status import Status
+from rich.console import Group
 from rich import box
 
+class _Deferred:
+    """
+    Placeholder for a heavy module or class that is imported on first use.
+
+    The first attribute access or call imports the real object and rebinds
+    the module-level name to it, so later uses pay nothing extra.
+    """
+
+    def __init__(self, name, module, attr=None, wrap=None):
+        self._name = name
+        self._module = module
+        self._attr = attr
+        self._wrap = wrap  # Optional callable applied to the imported object (e.g. to subclass it)
+
+    # Imports are serialized: the background warm-up and the main thread racing to import
+    # the same package can otherwise see it half-initialized
+    _lock = threading.RLock()
+
+    def _load(self):
+        with self._lock:
+            current = globals()[self._name]
+            if current is not self:
+                # Another thread loaded it while this one waited for the lock
+                return current
+            target = importlib.import_module(self._module)
+            if self._attr:
+                target = getattr(target, self._attr)
+            if self._wrap:
+                target = self._wrap(target)
+            globals()[self._name] = target
+            return target
+
+    def __call__(self, *args, **kwargs):
+        return self._load()(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+def _with_cached_code_blocks(markdown_class):
+    """Subclass rich's Markdown so its code blocks render through the syntax cache"""
+    class CachedCodeBlock(markdown_class.elements["fence"]):
+        def __rich_console__(self, console, options):
+            return highlighted_code(str(self.text).rstrip(), self.lexer_name, console, options, theme=self.theme)
+
+    class CachedMarkdown(markdown_class):
+        elements = {**markdown_class.elements, "fence": CachedCodeBlock, "code_block": CachedCodeBlock}
+
+    return CachedMarkdown
+
+# Imported lazily: together these are most of the startup time and none is needed for the first prompt
+requests = _Deferred("requests", "requests")
+asyncio = _Deferred("asyncio", "asyncio")
+ssl = _Deferred("ssl", "ssl")
+Markdown = _Deferred("Markdown", "rich.markdown", "Markdown", wrap=_with_cached_code_blocks)
+Syntax = _Deferred("Syntax", "rich.syntax", "Syntax")
+Live = _Deferred("Live", "rich.live", "Live")
+Status = _Deferred("Status", "rich.status", "Status")
+Table = _Deferred("Table", "rich.table", "Table")
+sqlite3 = _Deferred("sqlite3", "sqlite3")
+DEFERRED_NAMES = ("requests", "asyncio", "ssl", "Markdown", "Syntax", "Live", "Status", "Table", "sqlite3")
+
+def load_deferred_imports():
+    """Import everything deferred; run in the background once the prompt is up"""
+    for name in DEFERRED_NAMES:
+        target = globals()[name]
+        if isinstance(target, _Deferred):
+            try:
+                target._load()
+            except ImportError:
+                pass
+    get_stream_decoder()
+
 # Global variables
 stop_streaming = False
+async_loop = None  # Event loop shared by --async turns (created on first use)
 console = Console()
 conversation_history = []
 max_result_len = 300 #Limits formatted display length only, not actual content stored in context
 multiline_mode = False  # Track persistent multi-line mode
+live_refresh_per_second = 10  # Max redraws/sec of the streaming Live view; chunks in between are coalesced
+render_mode = "auto"  # Streaming display: "live", "plain" or "auto" (live until the terminal falls behind)
+render_budget = 0.25  # Share of wall time Live redraws may take before the refresh rate is lowered
+min_refresh_per_second = 2  # Below this achievable rate, auto mode switches to plain text
+render_policy = None  # RenderPolicy shared by every turn, created on first use
+transport = None  # ChatTransport shared by every turn, created on first use or by main()
+async_mode = False  # Stream turns through the asyncio pipeline (--async)
+stream_queue_size = 1024  # Bound on line batches/events buffered between the asyncio stages
+json_backend = "auto"  # JSON library used to decode stream events (--json-backend)
+stream_decoder = None  # StreamDecoder shared by every turn, created on first use
+context_budget = 0  # Token budget for the messages sent each turn; 0 sends the full history
+context_keep_turns = 3  # Most recent user turns that are always sent untouched
+context_excerpt_chars = 1500  # Characters kept from each end of a compacted tool result
+journal = None  # SessionJournal receiving every message as it is added (None when disabled)
+last_save = None  # (history list, filename, messages written, file size) of the latest /save
+lazy_load_threshold = 16 * 1024 * 1024  # Saved files at least this big are memory-mapped and decoded on demand
+history_tail = 20  # Messages shown after loading a conversation
+history_page_size = 10  # Messages per /history page
+history_search = None  # (term, index of the last match) so repeating /history --search steps back
+sessions = OrderedDict()  # Session name -> ChatSession (/session)
+current_session = None  # The ChatSession in the foreground
+journaling = True  # Whether new sessions get a journal (off with --no-journal)
+panel_cache = OrderedDict()  # (index, role, content hash, width) -> rendered history panel segments
+panel_cache_size = 512
+syntax_cache = OrderedDict()  # (language, theme, line numbers, code hash, code length, width) -> highlighted segments
+syntax_cache_size = 256
+tool_preview_lines = 12  # Lines of a tool result shown in its panel; /tool N pages through the rest
+tool_preview_chars = 1500
+tool_page_lines = 60  # Lines per /tool page
+tool_view = None  # (result number, result length, language, lines) of the result paged last
+tool_result_index = None  # (history, messages scanned, indices of the tool results among them), see tool_result_indices
+turn_metrics = []  # TurnMetrics summaries of recent turns, newest last (shown by /stats)
+metrics_keep = 200
+metrics_file = None  # JSONL file each turn summary is appended to (--metrics-file)
+JOURNAL_DIR = os.path.join(os.path.expanduser("~"), ".qwen-agentic-cli", "journal")
+BLOB_DIR = os.path.join(os.path.expanduser("~"), ".qwen-agentic-cli", "blobs")
+blob_store = None  # BlobStore for large tool results, created on first use
+blob_threshold = 64 * 1024  # Tool results longer than this (characters) are stored out of line; 0 keeps all inline
+blob_cache_bytes = 64 * 1024 * 1024  # Memory kept for recently used blobs
+tool_result_policy = "full"  # What is sent for a stored tool result: "full", "excerpt" or "digest"
+delta_session = None  # DeltaSession when the delta request protocol is on (--delta)
+endpoint_pools = {}  # --url value -> EndpointPool
+endpoint_strategy = "least-outstanding"  # How a pool picks an endpoint: "least-outstanding" or "latency"
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".qwen-agentic-cli", "cache")
+response_cache = None  # ResponseCache replaying repeated requests (--cache)
+cache_max_bytes = 256 * 1024 * 1024
+cache_max_entries = 1000
+SEARCH_DB = os.path.join(os.path.expanduser("~"), ".qwen-agentic-cli", "search.db")
+search_index = None  # SearchIndex over saved conversations and journals, opened on first use
+search_results = []  # Hits of the last /search, for /search show|open N
+PROFILE_DIR = os.path.join(os.path.expanduser("~"), ".qwen-agentic-cli", "profiles")
+profiler = None  # SamplingProfiler while profiling is on (/profile on or --profile)
+paste_limit = 256 * 1024  # Pastes longer than this (characters) are offered as an attachment
+paste_quiet = 0.05  # Seconds without new input that end a paste
+PASTE_START, PASTE_END = "\x1b[200~", "\x1b[201~"  # Bracketed paste markers
 
 #FIXME: DELETE ME
 # def signal_handler(sig, frame):
@@ -34,268 +174,3436 @@ multiline_mode = False  # Track persistent multi-line mode
 #         stop_streaming = True
 #         console.print("\n[bold red]Stopping response...[/bold red]")
 
-def format_code_blocks(text):
-    """Format code blocks within markdown text"""
-    if "```" not in text:
-        return text
-    
-    parts = []
-    in_code_block = False
-    code_content = ""
-    code_language = ""
+def highlighted_code(code, language, console, options, theme="monokai", line_numbers=False):
+    """
+    Rendered segments for a highlighted code block, from a bounded LRU so an
+    unchanged block is lexed once per width no matter how often it is redrawn.
+    """
+    key = (language, theme, line_numbers, hash(code), len(code), options.max_width)
+    segments = syntax_cache.get(key)
+    if segments is None:
+        syntax = Syntax(code, language, theme=theme, word_wrap=True, padding=1, line_numbers=line_numbers)
+        segments = list(console.render(syntax, options))
+        syntax_cache[key] = segments
+        if len(syntax_cache) > syntax_cache_size:
+            syntax_cache.popitem(last=False)
+    else:
+        syntax_cache.move_to_end(key)
+    return segments
+
+class CachedSyntax:
+    """Renderable for one code block, highlighted through the syntax cache"""
+
+    def __init__(self, code, language="text", theme="monokai", line_numbers=False):
+        self.code = code
+        self.language = language
+        self.theme = theme
+        self.line_numbers = line_numbers
+
+    def __rich_console__(self, console, options):
+        return highlighted_code(self.code, self.language, console, options, self.theme, self.line_numbers)
+
+def classify_tool_result(result):
+    """
+    (kind, language, start) of a tool result, judged from its first line only:
+    kind is "json", "code" (a fenced block) or "text", and the body starts at
+    result[start:].
+    """
+    start = len(TOOL_RESULT_PREFIX) if result.startswith(TOOL_RESULT_PREFIX) else 0
+    while start < len(result) and result[start] in " \t\r\n":
+        start += 1
+    line_end = result.find("\n", start, start + 256)
+    fence = match_fence(result[start:line_end]) if line_end != -1 else None
+    if fence:
+        language = fence[2] or "text"
+        return ("json" if language == "json" else "code"), language, line_end + 1
+    if result[start:start + 1] in ("{", "["):
+        return "json", "json", start
+    return "text", "text", start
+
+def tool_result_lines(result, kind, start, limit, max_line=2000):
+    """
+    Up to `limit` display lines of a tool result body from `start`, long lines
+    cut into max_line pieces, and whether more follows. Only as much of the
+    result as is returned gets scanned.
+    """
+    lines = []
+    pos = start
+    size = len(result)
+    while pos < size and len(lines) < limit:
+        end = result.find("\n", pos, pos + max_line)
+        if end == -1:
+            end = min(pos + max_line, size)
+            lines.append(result[pos:end])
+            pos = end
+        else:
+            lines.append(result[pos:end])
+            pos = end + 1
+    if kind != "text" and lines and pos >= size and lines[-1].strip().startswith(("```", "~~~")):
+        lines.pop()  # Closing fence of a fenced result
+    return lines, pos < size
+
+def tool_result_body(lines, language):
+    text = "\n".join(lines)
+    return Text(text) if language == "text" else CachedSyntax(text, language)
+
+def format_tool_result(result, number=None):
+    """
+    Panel body for a tool result: its first tool_preview_lines lines,
+    highlighted by type, so the cost is bounded however large it is. Small
+    JSON results are pretty-printed; the full result is paged with /tool N.
+    """
+    kind, language, start = classify_tool_result(result)
+    if kind == "json" and len(result) - start <= tool_preview_chars:
+        try:
+            body = json.dumps(json.loads(result[start:]), indent=2)
+            result, start = body, 0
+        except json.JSONDecodeError:
+            pass  # Not JSON after all, or a fenced block with text after it
+    lines, more = tool_result_lines(result, kind, start, tool_preview_lines, tool_preview_chars)
+    while sum(len(line) for line in lines) > tool_preview_chars and len(lines) > 1:
+        lines.pop()
+        more = True
+    if not more:
+        return tool_result_body(lines, language)
+    shown = sum(len(line) + 1 for line in lines)
+    where = f"/tool {number}" if number else "/tool N"
+    note = Text(f"... {max(0, len(result) - start - shown):,} more characters; {where} shows the full result", style="dim")
+    return Group(tool_result_body(lines, language), note)
+
+# Markdown block boundaries used by the incremental renderer
+FENCE_RE = re.compile(r"^( {0,3})(`{3,}|~{3,})(.*)$")
+LIST_ITEM_RE = re.compile(r"^ {0,3}(?:[-*+]|\d{1,9}[.)])(?:\s|$)")
+HEADING_RE = re.compile(r"^ {0,3}#{1,6}(?:\s|$)")
+RULE_RE = re.compile(r"^ {0,3}([-*_])(?:[ \t]*\1){2,}[ \t]*$")
+
+def match_fence(line):
+    """(indent, marker, language) if line opens a fenced code block, else None"""
+    match = FENCE_RE.match(line)
+    if match is None:
+        return None
+    indent, marker, info = match.groups()
+    # A backtick fence's info string cannot contain backticks (``` x ``` is inline code)
+    if marker[0] == "`" and "`" in info:
+        return None
+    return len(indent), marker, info.strip().split(" ", 1)[0]
+
+def closes_fence(line, marker):
+    """True if line closes a fence opened with marker"""
+    stripped = line.lstrip(" ")
+    return (len(line) - len(stripped) <= 3 and stripped.startswith(marker)
+            and not stripped.rstrip().strip(marker[0]))
+
+class _RenderedBlock:
+    """A finished markdown block, rendered once per width and then replayed"""
+
+    def __init__(self, text):
+        self.text = text
+        # Rich puts no blank line after a horizontal rule
+        self.new_line = not RULE_RE.match(text.rsplit("\n", 1)[-1])
+        self._width = None
+        self._segments = None
+
+    def __rich_console__(self, console, options):
+        if self._width != options.max_width:
+            self._segments = list(console.render(Markdown(self.text), options))
+            self._width = options.max_width
+        return self._segments
+
+class IncrementalMarkdown:
+    """
+    Markdown renderable for a reply that is still streaming in.
+
+    The buffer is split into finished blocks (paragraphs, closed code fences,
+    lists, headings) whose rendered output is cached, plus one open tail block
+    which is the only part re-parsed when the text grows.
+    """
+
+    def __init__(self):
+        self._parts = []          # every chunk fed so far, joined on demand
+        self._blocks = []         # _RenderedBlock for each finished block
+        self._tail_lines = []     # complete lines of the open block
+        self._tail_has_content = False
+        self._partial = ""        # trailing text without a newline yet
+        self._fence = None        # opening fence marker while inside a code fence
+        self._in_list = False
+        self._saw_blank = False
+        self._tail_md = None      # cached Markdown for the open block
+
+    @property
+    def text(self):
+        """Full markdown source received so far"""
+        if len(self._parts) > 1:
+            self._parts = ["".join(self._parts)]
+        return self._parts[0] if self._parts else ""
+
+    def feed(self, content):
+        """Append streamed text and move any blocks it completes into the cache"""
+        if not content:
+            return
+        self._parts.append(content)
+        self._tail_md = None
+        data = self._partial + content
+        if "\n" not in data:
+            self._partial = data
+            return
+        *lines, self._partial = data.split("\n")
+        for line in lines:
+            self._add_line(line)
+
+    def _add_line(self, line):
+        """Classify one complete line and close the open block when it ends"""
+        if self._fence:
+            self._tail_lines.append(line)
+            if closes_fence(line, self._fence):
+                self._fence = None
+                # A fence nested in a list item leaves the list open
+                if not self._in_list:
+                    self._close_block()
+            return
+
+        if not line.strip():
+            if self._tail_has_content:
+                self._saw_blank = True
+            self._tail_lines.append(line)
+            return
+
+        fence = match_fence(line)
+        heading = HEADING_RE.match(line)
+        continues_list = self._in_list and (LIST_ITEM_RE.match(line) or line[:1] in (" ", "\t"))
+        if self._tail_has_content and (heading or (fence and not continues_list)):
+            self._close_block()
+        elif self._saw_blank and not continues_list:
+            self._close_block()
+        self._saw_blank = False
+
+        if not self._tail_has_content:
+            self._in_list = bool(LIST_ITEM_RE.match(line))
+            self._tail_has_content = True
+        self._tail_lines.append(line)
+
+        if fence:
+            self._fence = fence[1]
+        elif heading:
+            self._close_block()
+
+    def _close_block(self):
+        """Move the open block into the finished-block cache"""
+        if self._tail_has_content:
+            self._blocks.append(_RenderedBlock("\n".join(self._tail_lines).strip("\n")))
+        self._tail_lines = []
+        self._tail_has_content = False
+        self._in_list = False
+        self._saw_blank = False
+
+    def __rich_console__(self, console, options):
+        if self._tail_md is None and (self._tail_has_content or self._partial.strip()):
+            self._tail_md = Markdown("\n".join(self._tail_lines + [self._partial]).strip("\n"))
+        pieces = self._blocks + ([self._tail_md] if self._tail_md is not None else [])
+
+        new_line = False
+        for piece in pieces:
+            segments = list(console.render(piece, options))
+            # Rich separates top-level blocks with a blank line unless the block brings its own
+            if new_line and segments and segments[0].text != "\n":
+                yield Segment.line()
+            yield from segments
+            new_line = getattr(piece, "new_line", True)
+
+class StreamEvent:
+    """
+    One decoded event of the streaming protocol.
+
+    Slotted so a long stream does not allocate a dict per chunk. `error` is
+    set (and `content` holds the raw line) when a line could not be decoded.
+    """
+
+    __slots__ = ("role", "content", "type", "error")
+
+    def __init__(self, role="", content="", type="", error=None):
+        self.role = role
+        self.content = content
+        self.type = type
+        self.error = error
+
+    @classmethod
+    def from_object(cls, obj, line=b""):
+        if not isinstance(obj, dict):
+            return cls.invalid(f"Unexpected event: {type(obj).__name__}", line)
+        return cls(obj.get('role') or '', obj.get('content') or '', obj.get('type') or '')
+
+    @classmethod
+    def invalid(cls, error, line):
+        return cls(content=line.decode("utf-8", errors="replace"), error=error)
+
+JSON_BACKENDS = ("orjson", "msgspec", "json")
+
+def load_json_backend(name="auto"):
+    """Return (name, loads, decode errors) for the requested backend, or the fastest installed one"""
+    for candidate in (JSON_BACKENDS if name == "auto" else (name,)):
+        try:
+            if candidate == "orjson":
+                orjson = importlib.import_module("orjson")
+                return candidate, orjson.loads, (orjson.JSONDecodeError,)
+            if candidate == "msgspec":
+                msgspec = importlib.import_module("msgspec")
+                return candidate, msgspec.json.Decoder().decode, (msgspec.DecodeError,)
+        except ImportError:
+            if name != "auto":
+                raise
+            continue
+        if candidate == "json":
+            return candidate, json.loads, (ValueError,)
+    raise ValueError(f"Unknown JSON backend: {name}")
+
+class StreamDecoder:
+    """
+    Decodes stream protocol lines straight from bytes into StreamEvent records.
+
+    Lines are handed over in batches (one network read at a time) and parsed
+    without decoding them to str first; orjson and msgspec accept UTF-8 bytes
+    directly, and stdlib json is the fallback.
+    """
+
+    def __init__(self, backend="auto"):
+        self.backend, self._loads, self._errors = load_json_backend(backend)
+
+    def decode(self, line):
+        try:
+            return StreamEvent.from_object(self._loads(line), line)
+        except self._errors as e:
+            return StreamEvent.invalid(f"Error parsing JSON: {e}", line)
+
+    def decode_batch(self, lines):
+        return [self.decode(line) for line in lines]
+
+def get_stream_decoder():
+    """Return the shared decoder, importing the JSON backend on first use"""
+    global stream_decoder
+    if stream_decoder is None:
+        stream_decoder = StreamDecoder(json_backend)
+    return stream_decoder
+
+class LineSplitter:
+    """
+    Splits a byte stream into lines a whole network read at a time.
+
+    A line spread over many reads (e.g. a multi-megabyte tool result) is kept
+    as a list of pieces and joined once, instead of re-concatenating the
+    partial line on every read.
+    """
+
+    __slots__ = ("_pending",)
+
+    def __init__(self):
+        self._pending = []
+
+    def feed(self, data):
+        """Return the complete non-blank lines in data; an unfinished last line is kept"""
+        if b"\n" not in data:
+            self._pending.append(data)
+            return []
+        lines = data.split(b"\n")
+        if self._pending:
+            self._pending.append(lines[0])
+            lines[0] = b"".join(self._pending)
+        rest = lines.pop()
+        self._pending = [rest] if rest else []
+        return [line for line in lines if line.strip()]
+
+    def flush(self):
+        """Return the last line if the stream did not end with a newline"""
+        line = b"".join(self._pending)
+        self._pending = []
+        return [line] if line.strip() else []
+
+REQUEST_ENCODINGS = ("zstd", "gzip")  # Request body codings, most preferred first
+REQUEST_CHUNK_SIZE = 64 * 1024  # Bytes of JSON encoded per chunk of a streamed request body
+
+def encoding_available(encoding):
+    """Whether the client can produce (and decode) the given content coding"""
+    if encoding == "zstd":
+        return importlib.util.find_spec("zstandard") is not None
+    return encoding in ("gzip", "deflate")
+
+def make_compressor(encoding):
+    if encoding == "gzip":
+        return zlib.compressobj(6, zlib.DEFLATED, 31)
+    if encoding == "zstd":
+        return importlib.import_module("zstandard").ZstdCompressor(level=3).compressobj()
+    return None
+
+def make_decompressor(encoding):
+    """Incremental decoder for a response Content-Encoding (None for identity or unknown codings)"""
+    if encoding == "gzip":
+        return zlib.decompressobj(31)
+    if encoding == "deflate":
+        return zlib.decompressobj()
+    if encoding == "zstd" and encoding_available("zstd"):
+        return importlib.import_module("zstandard").ZstdDecompressor().decompressobj()
+    return None
+
+_json_encoder = json.JSONEncoder(allow_nan=False)
+
+def iter_json_body(payload, encoding=None):
+    """
+    Serialize payload as JSON while it is being sent: yields byte chunks of
+    about REQUEST_CHUNK_SIZE, compressed with `encoding` if given, so a large
+    history is never held as one encoded string.
+    """
+    compressor = make_compressor(encoding)
+    pieces = []
+    size = 0
+    for piece in _json_encoder.iterencode(payload):
+        pieces.append(piece)
+        size += len(piece)
+        if size >= REQUEST_CHUNK_SIZE:
+            data = "".join(pieces).encode("utf-8")
+            pieces = []
+            size = 0
+            if compressor:
+                data = compressor.compress(data)
+            if data:
+                yield data
+    data = "".join(pieces).encode("utf-8")
+    if compressor:
+        data = compressor.compress(data) + compressor.flush()
+    if data:
+        yield data
+
+class ChatTransport:
+    """
+    Persistent HTTP transport for the streaming chat endpoint.
+
+    One requests.Session with a connection pool is reused across turns so
+    each turn skips the TCP (and TLS) handshake. Timeouts are split by phase:
+    connecting, waiting for the first byte, and idle gaps between lines once
+    the stream is flowing. Requests that fail before the server has accepted
+    them (refused or dropped connections, 502/503/504) are retried with
+    exponential backoff.
+
+    Request bodies are encoded while they are sent. Up to `stream_threshold`
+    bytes go out with a Content-Length as before; larger ones use chunked
+    transfer. With `compression` "auto" the body is compressed once the server
+    has listed a coding we support in an Accept-Encoding response header
+    (RFC 7694); "gzip" or "zstd" compresses from the first request, and "off"
+    never does. A 415 reply to a compressed body, or a 411 reply to a chunked
+    one, is answered by resending without it. `stream_compression` controls
+    whether the event stream itself may arrive compressed.
+
+    Pass a pre-configured `session` (e.g. one with an adapter mounted for a
+    local stub server) to exercise the transport offline.
+    """
+
+    RETRY_STATUSES = (502, 503, 504)
+
+    def __init__(self, connect_timeout=5.0, first_byte_timeout=120.0, idle_timeout=300.0,
+                 retries=2, backoff=0.5, pool_size=4, session=None,
+                 compression="auto", stream_compression=True, stream_threshold=1024 * 1024):
+        self.connect_timeout = connect_timeout
+        self.first_byte_timeout = first_byte_timeout
+        self.idle_timeout = idle_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.pool_size = pool_size
+        self.compression = compression
+        self.stream_compression = stream_compression
+        self.stream_threshold = stream_threshold
+        self.negotiated_encoding = None  # Request coding the server advertised (compression="auto")
+        self._session = session
+
+    def request_encoding(self):
+        """Content-Encoding for the next request body, or None"""
+        if self.compression == "auto":
+            return self.negotiated_encoding
+        return None if self.compression == "off" else self.compression
+
+    def accept_encoding(self, decodable=("gzip", "deflate", "zstd")):
+        """Accept-Encoding header for the event stream"""
+        if not self.stream_compression:
+            return "identity"
+        return ", ".join(e for e in decodable if encoding_available(e))
+
+    def note_response(self, response_headers):
+        """Pick up the request codings a server advertises in Accept-Encoding"""
+        if self.compression != "auto":
+            return
+        offered = {token.split(";")[0].strip().lower()
+                   for token in (response_headers.get("Accept-Encoding") or "").split(",")}
+        self.negotiated_encoding = next(
+            (e for e in REQUEST_ENCODINGS if e in offered and encoding_available(e)), None)
+
+    def refuse(self, status, encoding, streamed):
+        """Adapt after a 415/411 reply; returns True if the request is worth resending"""
+        if status == 415 and encoding:
+            if self.compression == "auto":
+                self.negotiated_encoding = None
+            else:
+                console.print(f"[yellow]The server does not accept {encoding} request bodies, sending them uncompressed[/yellow]")
+                self.compression = "off"
+            return True
+        if status == 411 and streamed:
+            # Server needs a Content-Length: buffer every body from now on
+            self.stream_threshold = None
+            return True
+        return False
+
+    def request_body(self, payload):
+        """Return (body, headers, encoding, streamed) for payload: bytes when small, a chunk iterator otherwise"""
+        encoding = self.request_encoding()
+        headers = {"Content-Type": "application/json"}
+        if encoding:
+            headers["Content-Encoding"] = encoding
+        chunks = iter_json_body(payload, encoding)
+        head = []
+        size = 0
+        for chunk in chunks:
+            head.append(chunk)
+            size += len(chunk)
+            if self.stream_threshold is not None and size > self.stream_threshold:
+                return itertools.chain(head, chunks), headers, encoding, True
+        return b"".join(head), headers, encoding, False
+
+    @property
+    def session(self):
+        """The pooled requests.Session, created on first use so startup does not import requests"""
+        if self._session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size, max_retries=0)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            self._session = session
+        return self._session
+
+    def post_stream(self, url, payload, headers=None, retries=None, deadline=None):
+        """POST payload and return the open streaming response; `deadline` (perf_counter time) caps the waits"""
+        retries = self.retries if retries is None else retries
+        request_headers = {'Accept': 'text/event-stream', 'Accept-Encoding': self.accept_encoding()}
+        if headers:
+            request_headers.update(headers)
+
+        attempt = 0
+        while True:
+            # Encoded afresh for every attempt, since a streamed body can only be sent once
+            body, body_headers, encoding, streamed = self.request_body(payload)
+            timeouts = (self.connect_timeout, self.first_byte_timeout)
+            if deadline is not None:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    raise requests.Timeout(f"No response from {url} before the deadline")
+                timeouts = (min(timeouts[0], remaining), min(timeouts[1], remaining))
+            try:
+                response = self.session.post(
+                    url, data=body, stream=True, headers={**request_headers, **body_headers},
+                    timeout=timeouts
+                )
+                if response.status_code in (411, 415) and self.refuse(response.status_code, encoding, streamed):
+                    response.close()
+                    continue
+                if response.status_code in self.RETRY_STATUSES and attempt < retries:
+                    response.close()
+                else:
+                    if response.status_code >= 400:
+                        # Closed here, as callers that fail over only see the HTTPError
+                        response.close()
+                    response.raise_for_status()
+                    self.note_response(response.headers)
+                    return response
+            except requests.ConnectionError:
+                # Only connect-phase failures land here; a read timeout means the
+                # server already has the request, so it is never replayed
+                if attempt >= retries:
+                    raise
+            attempt += 1
+            time.sleep(self.backoff * (2 ** (attempt - 1)))
+
+    def iter_line_batches(self, response):
+        """Yield lists of raw (bytes) lines, switching to the idle timeout once data is flowing"""
+        splitter = LineSplitter()
+        # Chunked responses are read one HTTP chunk at a time, as it arrives; other
+        # bodies in small reads so a partial buffer is never held back for long
+        chunk_size = None if getattr(response.raw, "chunked", False) else 512
+        first = True
+        for data in response.iter_content(chunk_size=chunk_size):
+            if first:
+                first = False
+                self._set_read_timeout(response, self.idle_timeout)
+            lines = splitter.feed(data)
+            if lines:
+                yield lines
+        lines = splitter.flush()
+        if lines:
+            yield lines
+
+    def iter_lines(self, response):
+        """Yield raw (bytes) lines one at a time"""
+        for lines in self.iter_line_batches(response):
+            yield from lines
+
+    @staticmethod
+    def _set_read_timeout(response, seconds):
+        """Change the socket read timeout of an in-flight streaming response"""
+        try:
+            response.raw.connection.sock.settimeout(seconds)
+        except AttributeError:
+            # Connection already released or not socket-backed (e.g. a test adapter)
+            pass
+
+    @staticmethod
+    def abort(response):
+        """Cut off a streaming response from another thread, unblocking a pending read"""
+        try:
+            response.raw.connection.sock.shutdown(socket.SHUT_RDWR)
+        except (AttributeError, OSError):
+            pass
+        response.close()
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
+
+def get_transport():
+    """Return the shared transport, creating one with default settings if needed"""
+    global transport
+    if transport is None:
+        transport = ChatTransport()
+    return transport
+
+def message_digest(message):
+    """SHA-256 of a message's compact, key-sorted JSON (role and content only)"""
+    canonical = json.dumps({"role": message.get("role", ""), "content": message.get("content", "")},
+                           sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+def prefix_fingerprints(messages, digests=None):
+    """
+    Fingerprint of every prefix of messages: entry i covers messages[:i + 1] and
+    is sha256(previous fingerprint + message digest), starting from "".
+    `digests` memoizes message digests across calls.
+    """
+    fingerprints = []
+    previous = ""
+    for message in messages:
+        content = message.get("content", "")
+        key = (message.get("role", ""), hash(content), len(content))
+        digest = digests.get(key) if digests is not None else None
+        if digest is None:
+            digest = message_digest(message)
+            if digests is not None:
+                digests[key] = digest
+        previous = hashlib.sha256((previous + digest).encode("ascii")).hexdigest()
+        fingerprints.append(previous)
+    return fingerprints
+
+class DeltaRejected(Exception):
+    """The server does not know the prefix a delta request was based on"""
+
+class EndpointUnavailable(ConnectionError):
+    """The asyncio client could not get a request accepted by an endpoint"""
+
+class DeltaSession:
+    """
+    Client side of the optional delta request protocol (--delta).
+
+    Every request names the session (session_id) and fingerprints the whole
+    message list it stands for ("prefix": count and hash, also sent as the
+    X-Session-Id and X-Prefix-Hash headers), so a server-side KV/prefix cache
+    can key on it. A server that stored the request echoes the prefix hash in
+    the X-Prefix-Ack response header. The next request then sends only the
+    messages after that acknowledged prefix and names it as "base". A server
+    that does not recognize the base answers 409, and the client resends the
+    full history. Servers that never acknowledge always get full requests.
+    """
+
+    ACK_HEADER = "X-Prefix-Ack"
+    REJECTED_STATUS = 409
+
+    def __init__(self):
+        self.id = uuid.uuid4().hex
+        self.acked = {}  # endpoint URL -> (count, fingerprint) of its last acknowledged request
+        self.full_sends = 0
+        self.delta_sends = 0
+        self.fallbacks = 0
+        self._digests = {}
+
+    def prepare(self, url, messages, payload, delta=True):
+        """Return (body, headers, prefix) for a request to url standing for `messages`"""
+        if len(self._digests) > 2 * len(messages) + 64:
+            # Mostly digests of messages that left the history (/clear, /load, compaction)
+            self._digests = {}
+        fingerprints = prefix_fingerprints(messages, self._digests)
+        prefix = (len(messages), fingerprints[-1] if fingerprints else "")
+        body = dict(payload, session_id=self.id, prefix={"count": prefix[0], "hash": prefix[1]})
+        headers = {"X-Session-Id": self.id, "X-Prefix-Hash": prefix[1]}
+
+        base = self.acked.get(url)
+        if delta and base and 0 < base[0] <= len(messages) and fingerprints[base[0] - 1] == base[1]:
+            body["messages"] = messages[base[0]:]
+            body["base"] = {"count": base[0], "hash": base[1]}
+            self.delta_sends += 1
+        else:
+            body["messages"] = messages
+            self.full_sends += 1
+        return body, headers, prefix
+
+    def acknowledge(self, url, ack, prefix):
+        """Record the X-Prefix-Ack value url returned for a request sent with `prefix`"""
+        if ack and ack == prefix[1]:
+            self.acked[url] = prefix
+        else:
+            self.acked.pop(url, None)
+
+    def describe(self):
+        acked = (", ".join(f"{count} messages acknowledged by {url}" for url, (count, _) in self.acked.items())
+                 or "no prefix acknowledged")
+        return (f"Delta protocol: session {self.id[:12]}, {acked} | "
+                f"{self.delta_sends} delta / {self.full_sends} full requests, {self.fallbacks} fallbacks")
+
+class Endpoint:
+    """One chat endpoint of an EndpointPool, with its load and latency stats"""
+
+    __slots__ = ("url", "healthy", "outstanding", "requests", "failures", "consecutive_failures",
+                 "ttfb", "recent_ttfb", "last_error")
+
+    def __init__(self, url):
+        self.url = url
+        self.healthy = True
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.ttfb = None  # Moving average time to first byte, in seconds
+        self.recent_ttfb = deque(maxlen=100)
+        self.last_error = None
+
+class EndpointPool:
+    """
+    The endpoints given to --url (comma-separated), balanced on the client.
+
+    Each request goes to the healthy endpoint with the fewest requests in
+    flight ("least-outstanding", ties going to the least used) or with the lowest
+    average time to first byte weighted by its load ("latency"). A request
+    that fails before the server accepts it (connection refused or timed out,
+    502/503/504) fails over to the next endpoint. The endpoint is marked down
+    and probed with a TCP connect every `probe_interval` seconds until it
+    answers again. Like ChatTransport's retries, a request that timed out
+    waiting for its first byte is never sent elsewhere, since the server may
+    already be running its tools.
+    """
+
+    STRATEGIES = ("least-outstanding", "latency")
+
+    def __init__(self, urls, strategy="least-outstanding", probe_interval=5.0):
+        self.endpoints = [Endpoint(url) for url in urls]
+        self.strategy = strategy
+        self.probe_interval = probe_interval
+        self._lock = threading.Lock()
+        self._prober = None
+
+    def __len__(self):
+        return len(self.endpoints)
+
+    def __str__(self):
+        return ", ".join(endpoint.url for endpoint in self.endpoints)
+
+    def _score(self, endpoint):
+        if self.strategy == "latency":
+            ttfb = endpoint.ttfb or 0.0  # Unmeasured endpoints get tried first
+            return (ttfb * (endpoint.outstanding + 1), endpoint.requests)
+        return (endpoint.outstanding, endpoint.requests)
+
+    def candidates(self):
+        """Endpoints in the order a new request should try them; ones marked down come last"""
+        with self._lock:
+            healthy = sorted((e for e in self.endpoints if e.healthy), key=self._score)
+            down = sorted((e for e in self.endpoints if not e.healthy), key=lambda e: e.consecutive_failures)
+        return healthy + down
+
+    def start(self, endpoint):
+        with self._lock:
+            endpoint.outstanding += 1
+            endpoint.requests += 1
+
+    def connected(self, endpoint, seconds):
+        """Record a request that reached the server, with its time to first byte"""
+        with self._lock:
+            endpoint.ttfb = seconds if endpoint.ttfb is None else 0.7 * endpoint.ttfb + 0.3 * seconds
+            endpoint.recent_ttfb.append(seconds)
+            endpoint.consecutive_failures = 0
+            endpoint.healthy = True
+
+    def failed(self, endpoint, error, down=True):
+        """Record a request that never got a response; `down` takes the endpoint out of rotation"""
+        with self._lock:
+            endpoint.outstanding -= 1
+            endpoint.failures += 1
+            endpoint.last_error = f"{type(error).__name__}: {error}"
+            if down:
+                endpoint.consecutive_failures += 1
+                endpoint.healthy = False
+                if self._prober is None:
+                    self._prober = threading.Thread(target=self._probe_loop, daemon=True)
+                    self._prober.start()
+
+    def finish(self, endpoint):
+        """Record the end of a request that reached the server"""
+        with self._lock:
+            endpoint.outstanding -= 1
+
+    @staticmethod
+    def probe(endpoint, timeout=2.0):
+        """Health check: can a TCP connection to the endpoint be opened?"""
+        parts = urlsplit(endpoint.url)
+        port = parts.port or (443 if parts.scheme == "https" else 80)
+        try:
+            socket.create_connection((parts.hostname, port), timeout).close()
+            return True
+        except OSError:
+            return False
+
+    def _probe_loop(self):
+        while True:
+            time.sleep(self.probe_interval)
+            with self._lock:
+                down = [e for e in self.endpoints if not e.healthy]
+                if not down:
+                    self._prober = None
+                    return
+            for endpoint in down:
+                if self.probe(endpoint):
+                    with self._lock:
+                        endpoint.healthy = True
+
+def get_endpoint_pool(url):
+    """The EndpointPool for a --url value (one URL or several, comma-separated)"""
+    pool = endpoint_pools.get(url)
+    if pool is None:
+        urls = [u.strip() for u in url.split(",") if u.strip()]
+        pool = endpoint_pools[url] = EndpointPool(urls, endpoint_strategy)
+    return pool
+
+def is_failover_error(error):
+    """Errors raised before the server accepted the request, so another endpoint may take it"""
+    if isinstance(error, requests.HTTPError):
+        return error.response is not None and error.response.status_code in ChatTransport.RETRY_STATUSES
+    return isinstance(error, (requests.ConnectionError, EndpointUnavailable))
+
+def _post_to_endpoint(url, messages, payload, retries, delta, deadline=None):
+    """Send a turn to one endpoint, as a delta when the server allows it"""
+    transport = get_transport()
+    if delta is None or messages is None:
+        return transport.post_stream(url, payload, retries=retries, deadline=deadline)
+    body, headers, prefix = delta.prepare(url, messages, payload)
+    try:
+        response = transport.post_stream(url, body, headers, retries=retries, deadline=deadline)
+    except requests.HTTPError as e:
+        if "base" not in body or e.response is None or e.response.status_code != DeltaSession.REJECTED_STATUS:
+            raise
+        e.response.close()
+        delta.fallbacks += 1
+        body, headers, prefix = delta.prepare(url, messages, payload, delta=False)
+        response = transport.post_stream(url, body, headers, retries=retries, deadline=deadline)
+    delta.acknowledge(url, response.headers.get(DeltaSession.ACK_HEADER), prefix)
+    return response
+
+def open_chat_stream(url, messages, payload, delta=None, deadline=None):
+    """
+    POST a turn to the endpoint pool for url and return (response, endpoint).
+    Call the pool's finish(endpoint) once the response is closed. Pass
+    messages=None to always send the full payload. `delta` is the
+    DeltaSession to use (default: the foreground session's). `deadline`
+    (a time.perf_counter() value) bounds the wait for the response headers.
+    """
+    delta = delta_session if delta is None else delta
+    pool = get_endpoint_pool(url)
+    transport = get_transport()
+    # With one endpoint the transport retries it; with several, failing over replaces those retries
+    rounds, retries = (1, None) if len(pool) == 1 else (transport.retries + 1, 0)
+    last_error = None
+    for attempt in range(rounds):
+        if attempt:
+            time.sleep(transport.backoff * (2 ** (attempt - 1)))
+        for endpoint in pool.candidates():
+            pool.start(endpoint)
+            started = time.perf_counter()
+            try:
+                response = _post_to_endpoint(endpoint.url, messages, payload, retries, delta, deadline)
+            except KeyboardInterrupt:
+                pool.finish(endpoint)
+                raise
+            except Exception as e:
+                failover = is_failover_error(e)
+                pool.failed(endpoint, e, down=failover)
+                if not failover:
+                    raise
+                last_error = e
+                continue
+            pool.connected(endpoint, time.perf_counter() - started)
+            return response, endpoint
+    raise last_error
+
+def display_endpoints(url):
+    """Show the endpoint pool with per-endpoint load and latency"""
+    pool = get_endpoint_pool(url)
+
+    def ms(seconds):
+        return "-" if seconds is None else f"{seconds * 1000:.0f} ms"
+
+    table = Table(box=box.SIMPLE, show_edge=False)
+    table.add_column("Endpoint")
+    table.add_column("State")
+    table.add_column("In flight", justify="right")
+    table.add_column("Requests", justify="right")
+    table.add_column("Failures", justify="right")
+    table.add_column("TTFB avg", justify="right")
+    table.add_column("TTFB p50", justify="right")
+    table.add_column("TTFB p95", justify="right")
+    for endpoint in pool.endpoints:
+        recent = sorted(endpoint.recent_ttfb)
+        state = "[green]up[/green]" if endpoint.healthy else "[red]down[/red]"
+        table.add_row(endpoint.url, state, str(endpoint.outstanding), str(endpoint.requests), str(endpoint.failures),
+                      ms(endpoint.ttfb), ms(recent[len(recent) // 2] if recent else None),
+                      ms(recent[int(len(recent) * 0.95)] if recent else None))
+    console.print(table)
+    console.print(f"[dim]Selection: {pool.strategy}[/dim]")
+    for endpoint in pool.endpoints:
+        if endpoint.last_error:
+            console.print(f"[dim]{endpoint.url} last error: {endpoint.last_error}[/dim]")
+
+class RenderPolicy:
+    """
+    Adapts how streamed output is drawn to what the terminal keeps up with.
+
+    Every Live refresh is timed, including the write to the terminal, which is
+    where a slow SSH link or a terminal recorder shows up. The refresh interval
+    is stretched so redraws take at most `render_budget` of the wall time. In
+    auto mode, once even `min_refresh_per_second` would exceed that budget, the
+    rest of the session streams plain text and draws panels only when the
+    role changes.
+    """
+
+    SAMPLES_BEFORE_SWITCH = 3  # Ignore the first refreshes, which pay for one-off imports and caches
+
+    def __init__(self, mode="auto"):
+        self.mode = mode
+        self.cost = None  # Moving average of one refresh, in seconds
+        self.refreshes = 0
+        self.switched = False
+
+    @property
+    def plain(self):
+        return self.mode == "plain" or (self.mode == "auto" and self.switched)
+
+    def interval(self):
+        """Seconds to wait between Live refreshes"""
+        interval = 1 / live_refresh_per_second
+        if self.mode == "live" or self.cost is None:
+            return interval
+        return max(interval, self.cost / render_budget)
+
+    def record(self, seconds):
+        """Record how long a refresh took; returns True when auto mode has just given up on Live"""
+        self.cost = seconds if self.cost is None else 0.7 * self.cost + 0.3 * seconds
+        self.refreshes += 1
+        if (self.mode == "auto" and not self.switched and self.refreshes >= self.SAMPLES_BEFORE_SWITCH
+                and self.interval() > 1 / min_refresh_per_second):
+            self.switched = True
+            return True
+        return False
+
+    def describe(self):
+        state = self.mode
+        if self.mode == "auto":
+            state += " (plain text, terminal too slow for live redraws)" if self.switched else " (live)"
+        if self.cost is None:
+            return f"Render mode: {state}"
+        return (f"Render mode: {state} | Refresh cost: {self.cost * 1000:.1f} ms | "
+                f"Refresh rate: {1 / self.interval():.1f}/s over {self.refreshes} refreshes")
+
+RENDER_MODES = ("auto", "live", "plain")
+
+def get_render_policy():
+    """Return the shared render policy, creating one for render_mode if needed"""
+    global render_policy
+    if render_policy is None:
+        render_policy = RenderPolicy(render_mode)
+    return render_policy
+
+class PlainLive:
+    """
+    Stand-in for Live used in plain mode: new text is written raw as it
+    arrives. The final renderable is printed on stop() only when nothing was
+    streamed (tool results), so a reply is never output twice.
+    """
+
+    def __init__(self, md=None):
+        self.md = md
+        self.written = 0
+        self.final = None
+
+    def start(self):
+        pass
+
+    def refresh(self):
+        if self.md is None:
+            return
+        text = self.md.text
+        new = text[self.written:]
+        if not new:
+            return
+        # Same left indent as the Live view
+        new = new.replace("\n", "\n    ")
+        console.file.write(("    " + new) if self.written == 0 else new)
+        console.file.flush()
+        self.written = len(text)
+
+    def update(self, renderable):
+        self.final = renderable
+
+    def stop(self):
+        self.refresh()
+        if self.written:
+            console.file.write("\n\n")
+            console.file.flush()
+        elif self.final is not None:
+            console.print(self.final)
+
+class StreamRenderer:
+    """
+    Turns decoded stream events into Live panels and conversation history.
+
+    Shared by the blocking and asyncio streaming paths: feed it each event
+    dict with handle() and call close() once the stream ends or is cut off.
+    With record=False it only displays (for events whose messages were
+    already recorded by a background session); tool panels are then numbered
+    on from `tool_number`, the number of the last tool result shown.
+    """
+
+    def __init__(self, record=True, tool_number=0):
+        self.record = record
+        self.tool_number = tool_number
+        self.current_role = ""
+        self.current_live = None
+        self.assistant_md = IncrementalMarkdown()
+        self.last_refresh = 0.0
+        self.pending = False  # Assistant text received since the last refresh
+        self._flush_timer = None
+        # handle() and close() may run on a worker thread while the flush timer fires
+        self._lock = threading.RLock()
+
+    @property
+    def assistant_text(self):
+        """Text of the latest assistant message"""
+        return self.assistant_md.text
+
+    def start_assistant_live(self, md):
+        """Start a new Live component for assistant responses"""
+        if get_render_policy().plain:
+            return PlainLive(md)
+        # Redraws are driven manually so bursts of chunks coalesce into one refresh
+        live = Live(
+            Padding(md, (0, 0, 0, 4)), 
+            refresh_per_second=live_refresh_per_second, 
+            auto_refresh=False,
+            console=console
+        )
+        live.start()
+        return live
+
+    def start_tool_live(self):
+        """Start a new Live component for tool responses"""
+        if get_render_policy().plain:
+            return PlainLive()
+        # Finalized right away, so no auto-refresh thread is needed
+        live = Live(
+            Padding("", (0, 0, 0, 4)), 
+            auto_refresh=False,
+            console=console
+        )
+        live.start()
+        return live
+
+    def finalize_assistant_live(self, live, message):
+        """Finalize assistant Live with a Panel"""
+        if message:
+            final_content = Markdown(message)
+            final_panel = Panel(
+                final_content, 
+                title="Assistant", 
+                border_style="violet", 
+                box=box.ROUNDED
+            )
+            live.update(Padding(final_panel, (0, 4, 0, 4)))
+        if self.record:
+            record_message({"role": "assistant", "content": message})
+
+        live.stop()
+
+    def finalize_tool_live(self, live, content):
+        """Finalize tool Live with a Panel"""
+        if self.record:
+            # This result becomes the next one in the history
+            number = count_tool_results() + 1
+        else:
+            # Replayed from a background session, whose history may already hold later results
+            self.tool_number += 1
+            number = self.tool_number
+        formatted_result = format_tool_result(content, number)
+        final_panel = Panel(
+            formatted_result, 
+            title="Tool Result", 
+            border_style="cyan",
+            box=box.ROUNDED
+        )
+        live.update(Padding(final_panel, (0, 4, 0, 4)))
+        live.stop()
+
+    def handle(self, event):
+        """Apply one decoded StreamEvent"""
+        with self._lock:
+            self._handle(event)
+
+    def _handle(self, event):
+        role = event.role
+        content = event.content
+        msg_type = event.type
+
+        # Handle role transitions
+        if self.current_role != role:
+            # Finish previous Live component
+            if self.current_live:
+                if self.current_role == 'assistant':
+                    self.finalize_assistant_live(self.current_live, self.assistant_md.text)
+                elif self.current_role == 'tool_call':
+                    # Tool content should already be handled
+                    self.current_live.stop()
+            
+            # Start new Live component
+            if role == 'assistant':
+                self.assistant_md = IncrementalMarkdown()  # Reset for new assistant message
+                self.current_live = self.start_assistant_live(self.assistant_md)
+            elif role == 'tool_call':
+                self.current_live = self.start_tool_live()
+            
+            self.current_role = role
+
+        # Handle content based on role
+        if role == 'assistant':
+            if msg_type == 'chunk':
+                self.assistant_md.feed(content)
+                self.pending = True
+                # Update the display no more often than the render policy allows
+                wait = get_render_policy().interval() - (time.monotonic() - self.last_refresh)
+                if wait <= 0:
+                    self.refresh_assistant()
+                elif self._flush_timer is None:
+                    # Draw held-back text at the end of the window even if the stream stalls there
+                    self._flush_timer = threading.Timer(wait, self._flush)
+                    self._flush_timer.daemon = True
+                    self._flush_timer.start()
+            
+            elif msg_type == 'done':
+                # This will be handled by role transition or final cleanup
+                pass
+                
+        elif role == 'tool_call':
+            # Handle tool call immediately and finalize
+            self.finalize_tool_live(self.current_live, content)
+            self.current_live = None  # Will be reset on next role transition
+            
+            # Store in conversation history (large results go to the blob store)
+            if self.record:
+                record_message(tool_result_message(content))
+
+    def refresh_assistant(self):
+        """Redraw the assistant view, timing it for the render policy"""
+        policy = get_render_policy()
+        started = time.monotonic()
+        self.current_live.refresh()
+        self.last_refresh = time.monotonic()
+        self.pending = False
+        if not isinstance(self.current_live, PlainLive) and policy.record(self.last_refresh - started):
+            self.switch_to_plain()
+
+    def _flush(self):
+        with self._lock:
+            self._flush_timer = None
+            if self.pending and self.current_role == 'assistant' and self.current_live is not None:
+                self.refresh_assistant()
+
+    def switch_to_plain(self):
+        """Replace the assistant Live view with plain text output mid-stream"""
+        # Erase the live region and write everything received so far as text
+        self.current_live.transient = True
+        self.current_live.stop()
+        self.current_live = PlainLive(self.assistant_md)
+        self.current_live.refresh()
+
+    def close(self):
+        """Clean up any remaining Live component"""
+        with self._lock:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+            self._close()
+
+    def _close(self):
+        if self.current_live:
+            if self.current_role == 'assistant':
+                self.finalize_assistant_live(self.current_live, self.assistant_md.text)
+            else:
+                self.current_live.stop()
+            self.current_live = None
+
+    def report_empty(self):
+        """Warn when a turn produced no assistant text at all"""
+        if not self.assistant_text:
+            console.print("[yellow]No response received from the server. You might need to check API connectivity or server logs.[/yellow]")
+            # Add a debug option for investigating response format
+            console.print("[dim]Try setting debug_mode=True in the script to see raw response data.[/dim]")
+
+TOOL_RESULT_PREFIX = "Tool result: "
+TOOL_RESULT_PREFIX_BYTES = TOOL_RESULT_PREFIX.encode()
+
+def is_tool_result(message):
+    """Tool outputs are stored as user messages carrying the tool result prefix"""
+    if isinstance(message, StoredMessage) and message.data is not None:
+        return message.role == "user" and message.data.startswith(TOOL_RESULT_PREFIX_BYTES)
+    return message.get("role") == "user" and message.get("content", "").startswith(TOOL_RESULT_PREFIX)
+
+def tool_result_indices():
+    """History indices of the tool results, scanning only the messages added since the last call"""
+    global tool_result_index
+    history = conversation_history
+    scanned, indices = 0, []
+    # /clear, /load and session switches all replace the history object
+    if tool_result_index is not None and tool_result_index[0] is history and tool_result_index[1] <= len(history):
+        _, scanned, indices = tool_result_index
+    lazy = isinstance(history, LazyConversation)
+    count = len(history)
+    for index in range(scanned, count):
+        found = history.stored_tool_result(index) if lazy else None
+        if found is None:
+            found = is_tool_result(history[index])
+        if found:
+            indices.append(index)
+    tool_result_index = (history, count, indices)
+    return indices
+
+def count_tool_results():
+    return len(tool_result_indices())
+
+def show_tool_result(args):
+    """/tool [N [page]]: page through the full text of tool result N (default: the latest)"""
+    global tool_view
+    indices = tool_result_indices()
+    if not indices:
+        console.print("[yellow]No tool results in this conversation[/yellow]")
+        return
+    try:
+        number = int(args[0]) if args else len(indices)
+        page = int(args[1]) if len(args) > 1 else 1
+    except ValueError:
+        console.print("[red]Usage: /tool \\[N \\[page]][/red]")
+        return
+    if not 1 <= number <= len(indices):
+        console.print(f"[red]Tool results are numbered 1 to {len(indices)}[/red]")
+        return
+    message = conversation_history[indices[number - 1]]
+    result = message["content"]
+    if message.get("blob"):
+        result = get_blob_store().get(message["blob"]) or result
+    # Formatting a large result takes a while, so it is kept for paging through it
+    if tool_view is None or tool_view[:2] != (number, len(result)):
+        size = len(result)
+        kind, language, start = classify_tool_result(result)
+        if kind == "json":
+            try:
+                result, start = json.dumps(json.loads(result[start:]), indent=2), 0
+            except json.JSONDecodeError:
+                pass
+        lines, _ = tool_result_lines(result, kind, start, len(result))
+        tool_view = (number, size, language, lines)
+    _, _, language, lines = tool_view
+    pages = max(1, (len(lines) + tool_page_lines - 1) // tool_page_lines)
+    page = max(1, min(page, pages))
+    chunk = lines[(page - 1) * tool_page_lines:page * tool_page_lines]
+    title = f"Tool Result #{number} [dim]page {page}/{pages}[/dim]"
+    console.print(Padding(Panel(tool_result_body(chunk, language), title=title, border_style="cyan", box=box.ROUNDED), (0, 4, 0, 4)))
+    if page < pages:
+        console.print(f"[dim]/tool {number} {page + 1} for the next page ({len(lines)} lines in all)[/dim]")
+
+def estimate_tokens(text):
+    """Cheap token estimate (~4 characters per token plus per-message overhead)"""
+    return len(text) // 4 + 4
+
+def excerpt_text(text, keep_chars, note="compacted"):
+    """Keep the head and tail of text with a marker for what was cut"""
+    if len(text) <= keep_chars * 2:
+        return text
+    omitted = len(text) - keep_chars * 2
+    return f"{text[:keep_chars]}\n[... {omitted} characters omitted, {note} ...]\n{text[-keep_chars:]}"
+
+def compact_messages(messages, budget, keep_turns=None, excerpt_chars=None):
+    """
+    Fit messages into a token budget without touching the stored history.
+
+    Policy, applied oldest first until the estimate fits:
+      1. tool results outside the protected recent turns are cut to a head/tail excerpt
+      2. whole turns outside the protected window are dropped, leaving one note in their place
+      3. tool results inside the protected window, except in the current turn, are excerpted
+    System messages and the last `keep_turns` user turns are always sent as-is.
+
+    Returns (messages_to_send, plan) where plan has one (index, action, tokens_before, tokens_after)
+    entry per original message.
+    """
+    keep_turns = context_keep_turns if keep_turns is None else keep_turns
+    excerpt_chars = context_excerpt_chars if excerpt_chars is None else excerpt_chars
+
+    sizes = [estimate_tokens(m.get("content", "")) for m in messages]
+    plan = [[i, "keep", size, size] for i, size in enumerate(sizes)]
+    total = sum(sizes)
+    if not budget or total <= budget:
+        return list(messages), plan
+
+    # Turns start at each real (non tool result) user message
+    turn_starts = [i for i, m in enumerate(messages) if m.get("role") == "user" and not is_tool_result(m)]
+    if keep_turns <= 0:
+        protected_from = len(messages)
+    elif len(turn_starts) > keep_turns:
+        protected_from = turn_starts[-keep_turns]
+    else:
+        protected_from = 0  # Everything is inside the protected window
+
+    contents = {}
+    def excerpt_tool_results(indices):
+        nonlocal total
+        for i in indices:
+            if total <= budget:
+                break
+            if is_tool_result(messages[i]) and i not in contents:
+                compacted = excerpt_text(messages[i]["content"], excerpt_chars, "old tool output compacted")
+                if len(compacted) < len(messages[i]["content"]):
+                    contents[i] = compacted
+                    total += estimate_tokens(compacted) - sizes[i]
+                    plan[i][1], plan[i][3] = "excerpt", estimate_tokens(compacted)
+
+    excerpt_tool_results(range(protected_from))
+
+    dropped = set()
+    for start, end in zip(turn_starts, turn_starts[1:] + [len(messages)]):
+        if total <= budget or end > protected_from:
+            break
+        for i in range(start, end):
+            if messages[i].get("role") != "system":
+                dropped.add(i)
+                total -= plan[i][3]
+                plan[i][1], plan[i][3] = "drop", 0
+    # Anything before the first user turn (other than system prompts) goes with the first drop
+    if dropped:
+        for i in range(turn_starts[0] if turn_starts else 0):
+            if messages[i].get("role") != "system" and i not in dropped:
+                dropped.add(i)
+                total -= plan[i][3]
+                plan[i][1], plan[i][3] = "drop", 0
+    # Last resort: excerpt tool results in the protected turns, but never in the current one
+    if turn_starts:
+        excerpt_tool_results(range(protected_from, turn_starts[-1]))
+
+    compacted_messages = []
+    note_added = False
+    for i, message in enumerate(messages):
+        if i in dropped:
+            if not note_added:
+                compacted_messages.append({"role": "user", "content": f"[Context note: {len(dropped)} earlier messages were omitted to fit the context budget]"})
+                note_added = True
+            continue
+        if i in contents:
+            message = dict(message, content=contents[i])
+        compacted_messages.append(message)
+    return compacted_messages, plan
+
+def build_request_messages(messages):
+    """Messages to send for the next turn, with stored tool results resolved and compacted to the context budget"""
+    return compact_messages([resolve_tool_result(m) for m in messages], context_budget)[0]
+
+def display_context_plan():
+    """Show what the next request will send under the current context budget"""
+    to_send, plan = compact_messages([resolve_tool_result(m) for m in conversation_history], context_budget)
+    before = sum(entry[2] for entry in plan)
+    after = sum(estimate_tokens(m.get("content", "")) for m in to_send)
+
+    table = Table(box=box.SIMPLE, show_edge=False)
+    table.add_column("#", justify="right", style="dim")
+    table.add_column("Role")
+    table.add_column("Tokens", justify="right")
+    table.add_column("Action")
+    action_styles = {"keep": "green", "excerpt": "yellow", "drop": "red"}
+    # Collapse runs of messages with the same action so long sessions stay readable
+    runs = []
+    for index, action, tokens_before, tokens_after in plan:
+        message = conversation_history[index]
+        role = "tool" if is_tool_result(message) else message.get("role", "")
+        if runs and runs[-1][3] == action and action != "excerpt":
+            runs[-1][1] = index
+            runs[-1][2].append(role)
+            runs[-1][4] += tokens_before
+            runs[-1][5] += tokens_after
+        else:
+            runs.append([index, index, [role], action, tokens_before, tokens_after])
+    for first, last, roles, action, tokens_before, tokens_after in runs:
+        label = str(first) if first == last else f"{first}-{last}"
+        role = roles[0] if len(roles) == 1 else f"{len(roles)} messages"
+        tokens = str(tokens_before) if tokens_before == tokens_after else f"{tokens_before} → {tokens_after}"
+        style = action_styles[action]
+        table.add_row(label, role, tokens, f"[{style}]{action}[/{style}]")
+
+    budget_text = f"{context_budget} tokens" if context_budget else "off (full history is sent)"
+    console.print(table)
+    console.print(f"[green]Budget: {budget_text} | History: ~{before} tokens in {len(plan)} messages | "
+                  f"Next request: ~{after} tokens in {len(to_send)} messages[/green]")
+    if delta_session is not None:
+        console.print(f"[dim]{delta_session.describe()}[/dim]")
+    stored = [m for m in conversation_history if m.get("blob")]
+    if stored:
+        console.print(f"[dim]{len(stored)} tool results ({sum(m.get('size', 0) for m in stored)} characters) "
+                      f"are stored as blobs and sent as: {tool_result_policy}[/dim]")
+
+class TurnMetrics:
+    """
+    Timing for one turn: request send, time to first byte, time to first
+    assistant chunk, gaps between chunks, each tool phase, and the time the
+    client itself spent rendering.
+    """
+
+    def __init__(self, url=""):
+        self.url = url
+        self.sent = time.perf_counter()
+        self.started_at = datetime.now().isoformat(timespec="seconds")
+        self.first_byte = None
+        self.first_chunk = None
+        self.last_chunk = None
+        self.last_event = None
+        self.finished = None
+        self.chunks = 0
+        self.chars = 0
+        self.gaps = []
+        self.tool_times = []
+        self.render_time = 0.0
+
+    def response_started(self):
+        self.first_byte = time.perf_counter()
+
+    def event(self, event):
+        """Record a decoded StreamEvent as it arrives"""
+        now = time.perf_counter()
+        role = event.role
+        if role == 'assistant' and event.type == 'chunk':
+            if self.first_chunk is None:
+                self.first_chunk = now
+            elif self.last_chunk is not None:
+                self.gaps.append(now - self.last_chunk)
+            self.last_chunk = now
+            self.chunks += 1
+            self.chars += len(event.content)
+        elif role == 'tool_call':
+            # Nothing streams while the server runs a tool, so the quiet period before its result is the tool phase
+            self.tool_times.append(now - (self.last_event or self.first_byte or self.sent))
+            self.last_chunk = None  # Gaps only count within an assistant segment
+        self.last_event = now
+
+    def add_render_time(self, seconds):
+        self.render_time += seconds
+
+    def finish(self):
+        self.finished = time.perf_counter()
+
+    def summary(self):
+        """Plain dict of the turn's metrics (milliseconds unless named otherwise)"""
+        def ms(start, end):
+            return round((end - start) * 1000, 1) if start is not None and end is not None else None
+
+        finished = self.finished or time.perf_counter()
+        gaps = sorted(self.gaps)
+        streaming = sum(self.gaps)
+        return {
+            "timestamp": self.started_at,
+            "url": self.url,
+            "ttfb_ms": ms(self.sent, self.first_byte),
+            "first_chunk_ms": ms(self.sent, self.first_chunk),
+            "total_ms": ms(self.sent, finished),
+            "chunks": self.chunks,
+            "chars": self.chars,
+            "chunks_per_sec": round(len(gaps) / streaming, 1) if streaming else None,
+            "chars_per_sec": round(self.chars / streaming, 1) if streaming else None,
+            "gap_mean_ms": round(streaming / len(gaps) * 1000, 1) if gaps else None,
+            "gap_p95_ms": round(gaps[int(len(gaps) * 0.95)] * 1000, 1) if gaps else None,
+            "gap_max_ms": round(gaps[-1] * 1000, 1) if gaps else None,
+            "tool_calls": len(self.tool_times),
+            "tool_ms": [round(t * 1000, 1) for t in self.tool_times],
+            "render_ms": round(self.render_time * 1000, 1),
+        }
+
+def record_turn_metrics(metrics):
+    """Keep a finished turn's summary for /stats and export it if --metrics-file is set"""
+    global metrics_file
+    metrics.finish()
+    summary = metrics.summary()
+    turn_metrics.append(summary)
+    del turn_metrics[:-metrics_keep]
+    if metrics_file:
+        try:
+            with open(metrics_file, "a", encoding="utf-8") as f:
+                f.write(json.dumps(summary) + "\n")
+        except OSError as e:
+            console.print(f"[red]Metrics export disabled ({metrics_file}): {e}[/red]")
+            metrics_file = None
+
+def display_stats():
+    """Show the last turn's metrics and averages over the session"""
+    if not turn_metrics:
+        console.print("[yellow]No turns recorded yet[/yellow]")
+        return
+
+    def fmt(value, unit=""):
+        return "-" if value is None else f"{value}{unit}"
+
+    def average(key):
+        values = [t[key] for t in turn_metrics if t[key] is not None]
+        return round(sum(values) / len(values), 1) if values else None
+
+    last = turn_metrics[-1]
+    table = Table(box=box.SIMPLE, show_edge=False)
+    table.add_column("Metric")
+    table.add_column("Last turn", justify="right")
+    table.add_column(f"Session avg ({len(turn_metrics)} turns)", justify="right")
+    rows = [
+        ("Time to first byte", "ttfb_ms", " ms"),
+        ("Time to first chunk", "first_chunk_ms", " ms"),
+        ("Total turn time", "total_ms", " ms"),
+        ("Chunks", "chunks", ""),
+        ("Chunks/sec", "chunks_per_sec", ""),
+        ("Chars/sec", "chars_per_sec", ""),
+        ("Inter-chunk gap (mean)", "gap_mean_ms", " ms"),
+        ("Inter-chunk gap (p95)", "gap_p95_ms", " ms"),
+        ("Inter-chunk gap (max)", "gap_max_ms", " ms"),
+        ("Tool calls", "tool_calls", ""),
+        ("Client render time", "render_ms", " ms"),
+    ]
+    for label, key, unit in rows:
+        table.add_row(label, fmt(last[key], unit), fmt(average(key), unit))
+    tool_total = round(sum(last["tool_ms"]), 1)
+    table.add_row("Tool phases", f"{tool_total} ms" if last["tool_ms"] else "-", "")
+    console.print(table)
+    if last["tool_ms"]:
+        console.print(f"[dim]Tool phases this turn (ms): {', '.join(str(t) for t in last['tool_ms'])}[/dim]")
+    if metrics_file:
+        console.print(f"[dim]Exporting to {metrics_file}[/dim]")
+
+class ResponseCache:
+    """
+    On-disk LRU cache of recorded event streams, keyed on the request.
+
+    The key covers the --url value, the messages sent (role and content,
+    with line endings and surrounding whitespace normalized), temperature and
+    max_output_tokens. Each entry is the raw event stream the turn received,
+    tool_call events included, in a file under `directory`, so a hit is
+    replayed through the normal decode and render path. Entries are evicted
+    least recently used first once there are more than `max_entries` or they
+    take more than `max_bytes`.
+    """
+
+    def __init__(self, directory, max_bytes=256 * 1024 * 1024, max_entries=1000):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.hits = self.misses = self.stores = self.evictions = 0
+        self._entries = OrderedDict()  # key -> size in bytes, least recently used first
+        self._bytes = 0
+        self._lock = threading.Lock()  # Batch workers share the cache
+        self._scan()
+
+    @staticmethod
+    def key(url, messages, temperature, max_tokens):
+        normalized = [[message.get("role", ""), str(message.get("content", "")).replace("\r\n", "\n").strip()]
+                      for message in messages]
+        canonical = json.dumps([url, normalized, float(temperature), int(max_tokens)],
+                               ensure_ascii=False, separators=(",", ":"))
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, f"{key}.jsonl")
+
+    def _scan(self):
+        try:
+            entries = [entry for entry in os.scandir(self.directory)
+                       if entry.name.endswith(".jsonl") and len(entry.name) == 70]  # sha256 hex + ".jsonl"
+        except OSError:
+            return
+        for entry in sorted(entries, key=lambda entry: entry.stat().st_mtime):
+            size = entry.stat().st_size
+            self._entries[entry.name[:-len(".jsonl")]] = size
+            self._bytes += size
+        self._evict()
+
+    def get(self, key):
+        """The recorded stream for key (bytes), or None"""
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            try:
+                with open(self.path(key), "rb") as f:
+                    data = f.read()
+                os.utime(self.path(key))  # Recency survives restarts
+            except OSError:
+                self._bytes -= self._entries.pop(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def put(self, key, lines):
+        """Store the raw (bytes) lines of a completed stream"""
+        data = b"".join(line + b"\n" for line in lines)
+        if not data or len(data) > self.max_bytes:
+            return
+        with self._lock:
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                temp = f"{self.path(key)}.{os.getpid()}.{threading.get_ident()}.tmp"
+                with open(temp, "wb") as f:
+                    f.write(data)
+                os.replace(temp, self.path(key))
+            except OSError as e:
+                console.print(f"[red]Could not write to the response cache: {e}[/red]")
+                return
+            self._bytes += len(data) - self._entries.pop(key, 0)
+            self._entries[key] = len(data)
+            self.stores += 1
+            self._evict()
+
+    def _evict(self):
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            key, size = self._entries.popitem(last=False)
+            self._bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(self.path(key))
+            except OSError:
+                pass
+
+    def clear(self):
+        """Delete every entry; returns how many there were"""
+        with self._lock:
+            count = len(self._entries)
+            for key in self._entries:
+                try:
+                    os.remove(self.path(key))
+                except OSError:
+                    pass
+            self._entries.clear()
+            self._bytes = 0
+            return count
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def size(self):
+        return self._bytes
+
+def lookup_cached_response(url, messages, temperature, max_tokens):
+    """(cache key, recorded stream or None), or (None, None) when the cache is off"""
+    if response_cache is None:
+        return None, None
+    key = response_cache.key(url, messages, temperature, max_tokens)
+    return key, response_cache.get(key)
+
+def display_cache_stats():
+    """Show the response cache's size, limits and hit rate"""
+    if response_cache is None:
+        console.print("[yellow]Response cache is off (start with --cache)[/yellow]")
+        return
+    cache = response_cache
+    lookups = cache.hits + cache.misses
+    hit_rate = f" ({cache.hits / lookups:.0%})" if lookups else ""
+    console.print(f"[bold]Response cache:[/bold] {cache.directory}")
+    console.print(f"  Entries: {len(cache)} / {cache.max_entries}")
+    console.print(f"  Size: {cache.size / 1048576:.1f} / {cache.max_bytes / 1048576:.0f} MB")
+    console.print(f"  This session: {cache.hits} hits{hit_rate}, {cache.misses} misses, "
+                  f"{cache.stores} stored, {cache.evictions} evicted")
+
+def process_streaming_response(url, messages, temperature=0.4, max_tokens=8000):
+    """Process streaming response from the API"""
+    global stop_streaming
+    stop_streaming = False
+    
+    payload = {
+        "messages": messages,
+        "temperature": temperature,
+        "max_output_tokens": max_tokens
+    }
+    
+    metrics = TurnMetrics(url)
+    try:
+        cache_key, replay = lookup_cached_response(url, messages, temperature, max_tokens)
+        if replay is not None:
+            response = endpoint = None
+            batches = [replay.splitlines()]
+            recorded = None
+            metrics.response_started()
+            metrics.url = "cache"
+        else:
+            # Show a message while waiting for the first response
+            with Status(Padding("[dim]Waiting for response...[/dim]", (0, 0, 0, 4)), console=console):
+                # Set up streaming request inside the status context
+                response, endpoint = open_chat_stream(url, messages, payload)
+            metrics.response_started()
+            metrics.url = endpoint.url
+            batches = get_transport().iter_line_batches(response)
+            recorded = [] if cache_key else None
+
+        console.print("")
+        renderer = StreamRenderer()
+        decoder = get_stream_decoder()
+
+        try:
+            for lines in batches:
+                if recorded is not None:
+                    recorded.extend(lines)
+                for event in decoder.decode_batch(lines):
+                    if stop_streaming:
+                        break
+                    if event.error:
+                        console.print(f"[red]{event.error}[/red]\n[dim]Raw data: {event.content}[/dim]")
+                        continue
+                    metrics.event(event)
+                    render_started = time.perf_counter()
+                    renderer.handle(event)
+                    metrics.add_render_time(time.perf_counter() - render_started)
+                if stop_streaming:
+                    break
+
+        finally:
+            render_started = time.perf_counter()
+            renderer.close()
+            metrics.add_render_time(time.perf_counter() - render_started)
+            if response is not None:
+                # Returns the connection to the pool, or drops it if the stream was cut short
+                response.close()
+                get_endpoint_pool(url).finish(endpoint)
+            record_turn_metrics(metrics)
+
+        if recorded is not None and not stop_streaming:
+            response_cache.put(cache_key, recorded)
+        # If we got no response at all
+        renderer.report_empty()
+            
+    except requests.Timeout as e:
+        console.print(f"[bold red]Timed out waiting for the server: {str(e)}[/bold red]")
+    except requests.RequestException as e:
+        console.print(f"[bold red]Network error: {str(e)}[/bold red]")
+    except Exception as e:
+        console.print(f"[bold red]Error: {str(e)}[/bold red]")
+        import traceback
+        console.print(f"[dim]{traceback.format_exc()}[/dim]")
+
+
+class AsyncHTTPStream:
+    """
+    Minimal HTTP/1.1 client on asyncio streams for one streaming POST.
+
+    Only what the chat endpoint needs: a request body given as bytes (sent
+    with a Content-Length) or as an iterable of chunks (sent chunked), then a
+    response body that is either chunked or delimited by Content-Length / EOF,
+    optionally gzip, deflate or zstd encoded. Every read is awaited, so
+    cancelling the task stops the stream immediately.
+
+    A connection whose response was read to the end is kept in `idle` and
+    reused by the next request to the same host, as long as the requests run
+    on the same event loop (see get_async_loop).
+    """
+
+    idle = {}  # (scheme, host, port) -> (reader, writer) of the keep-alive connection
+
+    def __init__(self, url, body, headers=None):
+        self.url = urlsplit(url)
+        self.body = body
+        self.headers = headers or {}
+        self.reader = None
+        self.writer = None
+        self.status = None
+        self.response_headers = {}
+        self.sent = False  # Whole request written, so it must not be sent again
+        self.complete = False  # Whole response read, so the connection can be reused
+        secure = self.url.scheme == "https"
+        self.key = (self.url.scheme, self.url.hostname, self.url.port or (443 if secure else 80))
+
+    async def open(self, connect_timeout, first_byte_timeout):
+        """Connect (or reuse the idle connection), send the request and read the status line and headers"""
+        connection = self.idle.pop(self.key, None)
+        if connection is not None:
+            # A streamed body cannot be sent twice, so it is not risked on a connection that may be stale
+            if not isinstance(self.body, bytes) or self._dropped(connection):
+                connection[1].close()
+            else:
+                self.reader, self.writer = connection
+                try:
+                    await self._write_request()
+                except ConnectionError:
+                    # The connection failed before the whole request went out, so the server cannot act on it
+                    self.writer.close()
+                else:
+                    # From here on the server may have the request: a failure is raised, never re-sent
+                    await self._read_head(first_byte_timeout)
+                    return
+        secure = self.url.scheme == "https"
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.url.hostname, self.key[2], ssl=ssl.create_default_context() if secure else None),
+            connect_timeout
+        )
+        await self._write_request()
+        await self._read_head(first_byte_timeout)
+
+    @staticmethod
+    def _dropped(connection):
+        """True if the server closed (or wrote to) an idle connection, which makes it unusable"""
+        reader, writer = connection
+        if reader.at_eof():
+            return True
+        try:
+            return bool(select.select([writer.get_extra_info("socket")], [], [], 0)[0])
+        except (OSError, ValueError, TypeError):
+            return True
+
+    async def _write_request(self):
+        """Send the request line, headers and body; sets `sent` once all of it is written"""
+        path = self.url.path or "/"
+        if self.url.query:
+            path += "?" + self.url.query
+        chunked = not isinstance(self.body, bytes)
+        head = [
+            f"POST {path} HTTP/1.1",
+            f"Host: {self.url.netloc}",
+            "Transfer-Encoding: chunked" if chunked else f"Content-Length: {len(self.body)}",
+        ]
+        head += [f"{k}: {v}" for k, v in self.headers.items()]
+        self.writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1"))
+        if chunked:
+            for chunk in self.body:
+                self.writer.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+                await self.writer.drain()
+            self.writer.write(b"0\r\n\r\n")
+        else:
+            self.writer.write(self.body)
+        await self.writer.drain()
+        self.sent = True
+
+    async def _read_head(self, first_byte_timeout):
+        """Read the status line and headers"""
+        status_line = await asyncio.wait_for(self.reader.readline(), first_byte_timeout)
+        if not status_line:
+            raise ConnectionError("Server closed the connection without responding")
+        self.status = int(status_line.split()[1])
+        while True:
+            line = await self.reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            self.response_headers[name.strip().lower()] = value.strip()
+
+    async def iter_body(self, idle_timeout):
+        """Yield decoded body bytes as they arrive"""
+        decompressor = make_decompressor(self.response_headers.get("content-encoding", "").lower())
+        async for data in self._iter_raw_body(idle_timeout):
+            if decompressor is not None:
+                data = decompressor.decompress(data)
+            if data:
+                yield data
+        if decompressor is not None and hasattr(decompressor, "flush"):
+            data = decompressor.flush()
+            if data:
+                yield data
+
+    async def _iter_raw_body(self, idle_timeout):
+        """Yield body bytes as they arrive on the wire"""
+        if self.response_headers.get("transfer-encoding", "").lower() == "chunked":
+            while True:
+                size_line = await asyncio.wait_for(self.reader.readline(), idle_timeout)
+                size = int(size_line.split(b";")[0].strip() or b"0", 16)
+                if size == 0:
+                    # Skip any trailers up to the blank line that ends the response
+                    while (await asyncio.wait_for(self.reader.readline(), idle_timeout)).strip():
+                        pass
+                    self.complete = True
+                    break
+                data = await asyncio.wait_for(self.reader.readexactly(size + 2), idle_timeout)
+                yield data[:-2]
+        else:
+            remaining = int(self.response_headers.get("content-length", -1))
+            while remaining != 0:
+                data = await asyncio.wait_for(self.reader.read(65536 if remaining < 0 else min(remaining, 65536)), idle_timeout)
+                if not data:
+                    break
+                remaining -= len(data) if remaining > 0 else 0
+                yield data
+            self.complete = remaining == 0
+
+    async def close(self):
+        if self.complete and self.response_headers.get("connection", "").lower() != "close":
+            previous = self.idle.pop(self.key, None)
+            if previous is not None:
+                previous[1].close()
+            self.idle[self.key] = (self.reader, self.writer)
+            self.writer = None
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except (OSError, ssl.SSLError):
+                pass
+
+async def _open_async_stream(url, payload, headers=None, retries=None):
+    """Open the streaming request, retrying connect failures like ChatTransport"""
+    settings = get_transport()
+    retries = settings.retries if retries is None else retries
+    request_headers = {"Accept": "text/event-stream", "Accept-Encoding": settings.accept_encoding()}
+    if headers:
+        request_headers.update(headers)
+    attempt = 0
+    while True:
+        body, body_headers, encoding, streamed = settings.request_body(payload)
+        stream = AsyncHTTPStream(url, body, {**request_headers, **body_headers})
+        try:
+            await stream.open(settings.connect_timeout, settings.first_byte_timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            await stream.close()
+            # Same rule as the blocking path: once the request is written the server
+            # may act on it, so only failures before that point are retried
+            if stream.sent:
+                raise
+            if attempt >= retries:
+                raise EndpointUnavailable(f"{type(e).__name__}: {e}") from e
+        else:
+            if stream.status < 400:
+                settings.note_response({k.title(): v for k, v in stream.response_headers.items()})
+                return stream
+            await stream.close()
+            if stream.status in (411, 415) and settings.refuse(stream.status, encoding, streamed):
+                continue
+            if stream.status == DeltaSession.REJECTED_STATUS and "base" in payload:
+                raise DeltaRejected(f"HTTP {stream.status} from {url}")
+            if stream.status not in ChatTransport.RETRY_STATUSES:
+                raise ConnectionError(f"HTTP {stream.status} from {url}")
+            if attempt >= retries:
+                raise EndpointUnavailable(f"HTTP {stream.status} from {url}")
+        attempt += 1
+        await asyncio.sleep(settings.backoff * (2 ** (attempt - 1)))
+
+async def _post_to_endpoint_async(url, messages, payload, retries):
+    """Asyncio counterpart of _post_to_endpoint"""
+    if delta_session is None:
+        return await _open_async_stream(url, payload, retries=retries)
+    body, headers, prefix = delta_session.prepare(url, messages, payload)
+    try:
+        stream = await _open_async_stream(url, body, headers, retries)
+    except DeltaRejected:
+        delta_session.fallbacks += 1
+        body, headers, prefix = delta_session.prepare(url, messages, payload, delta=False)
+        stream = await _open_async_stream(url, body, headers, retries)
+    delta_session.acknowledge(url, stream.response_headers.get(DeltaSession.ACK_HEADER.lower()), prefix)
+    return stream
+
+async def _open_chat_stream_async(url, messages, payload):
+    """Asyncio counterpart of open_chat_stream"""
+    pool = get_endpoint_pool(url)
+    transport = get_transport()
+    rounds, retries = (1, None) if len(pool) == 1 else (transport.retries + 1, 0)
+    last_error = None
+    for attempt in range(rounds):
+        if attempt:
+            await asyncio.sleep(transport.backoff * (2 ** (attempt - 1)))
+        for endpoint in pool.candidates():
+            pool.start(endpoint)
+            started = time.perf_counter()
+            try:
+                stream = await _post_to_endpoint_async(endpoint.url, messages, payload, retries)
+            except asyncio.CancelledError:
+                pool.finish(endpoint)
+                raise
+            except Exception as e:
+                failover = isinstance(e, EndpointUnavailable)
+                pool.failed(endpoint, e, down=failover)
+                if not failover:
+                    raise
+                last_error = e
+                continue
+            pool.connected(endpoint, time.perf_counter() - started)
+            return stream, endpoint
+    raise last_error
+
+class ReplayStream:
+    """Stands in for an AsyncHTTPStream when a turn is replayed from the response cache"""
+
+    def __init__(self, data):
+        self.data = data
+
+    async def iter_body(self, idle_timeout=None):
+        yield self.data
+
+    async def close(self):
+        pass
+
+async def _read_lines(stream, lines, recorded=None):
+    """Network stage: split the body into lines and hand them on a read at a time"""
+    splitter = LineSplitter()
+    async for data in stream.iter_body(get_transport().idle_timeout):
+        batch = splitter.feed(data)
+        if batch:
+            if recorded is not None:
+                recorded.extend(batch)
+            await lines.put(batch)
+    batch = splitter.flush()
+    if batch:
+        if recorded is not None:
+            recorded.extend(batch)
+        await lines.put(batch)
+    await lines.put(None)
+
+async def _decode_events(lines, events, metrics):
+    """Decode stage: parse batches of JSON lines into StreamEvents"""
+    decoder = get_stream_decoder()
+    while True:
+        batch = await lines.get()
+        if batch is None:
+            break
+        for event in decoder.decode_batch(batch):
+            if not event.error:
+                # Timed here, on arrival, so a backed-up render stage does not skew the gaps
+                metrics.event(event)
+            await events.put(event)
+    await events.put(None)
+
+def _render_batch(renderer, batch, metrics, lock):
+    """Apply a batch of events; runs in a worker thread so the event loop keeps reading"""
+    with lock:
+        render_started = time.perf_counter()
+        for event in batch:
+            if stop_streaming:
+                break
+            if event.error:
+                console.print(f"[red]{event.error}[/red]\n[dim]Raw data: {event.content}[/dim]")
+            else:
+                renderer.handle(event)
+        metrics.add_render_time(time.perf_counter() - render_started)
+
+async def _render_events(events, renderer, metrics, lock):
+    """
+    Render stage: drain whatever has queued up and render it in one go.
+
+    Cancelling this task does not stop a batch already running in its worker
+    thread; holding `lock` tells the caller when that thread is done with the
+    renderer.
+    """
+    while True:
+        batch = [await events.get()]
+        while not events.empty():
+            batch.append(events.get_nowait())
+        done = batch[-1] is None
+        batch = [event for event in batch if event is not None]
+        if batch:
+            await asyncio.to_thread(_render_batch, renderer, batch, metrics, lock)
+        if done:
+            break
+
+async def _stream_turn_async(url, messages, payload):
+    """Run the network, decode and render stages concurrently for one turn"""
+    global stop_streaming
+    loop = asyncio.get_running_loop()
+    main_task = asyncio.current_task()
+
+    def cancel():
+        global stop_streaming
+        stop_streaming = True
+        main_task.cancel()
+
+    try:
+        loop.add_signal_handler(signal.SIGINT, cancel)
+    except (NotImplementedError, RuntimeError):
+        pass  # e.g. Windows; Ctrl+C then surfaces as KeyboardInterrupt
+
+    stream = endpoint = recorded = None
+    cancelled = False
+    renderer = StreamRenderer()
+    render_lock = threading.Lock()
+    metrics = TurnMetrics(url)
+    try:
+        cache_key, replay = lookup_cached_response(url, messages, payload["temperature"], payload["max_output_tokens"])
+        if replay is not None:
+            stream = ReplayStream(replay)
+            metrics.url = "cache"
+        else:
+            with Status(Padding("[dim]Waiting for response...[/dim]", (0, 0, 0, 4)), console=console):
+                stream, endpoint = await _open_chat_stream_async(url, messages, payload)
+            metrics.url = endpoint.url
+            recorded = [] if cache_key else None
+        metrics.response_started()
+        console.print("")
+
+        lines = asyncio.Queue(maxsize=stream_queue_size)
+        events = asyncio.Queue(maxsize=stream_queue_size)
+        stages = [
+            asyncio.create_task(_read_lines(stream, lines, recorded)),
+            asyncio.create_task(_decode_events(lines, events, metrics)),
+            asyncio.create_task(_render_events(events, renderer, metrics, render_lock)),
+        ]
+        try:
+            await asyncio.gather(*stages)
+        finally:
+            for task in stages:
+                task.cancel()
+            await asyncio.gather(*stages, return_exceptions=True)
+        if recorded is not None and not stop_streaming:
+            response_cache.put(cache_key, recorded)
+        renderer.report_empty()
+    except asyncio.CancelledError:
+        cancelled = True
+    finally:
+        # A cancelled render batch may still be drawing in its worker thread;
+        # it stops at the next event once stop_streaming is set
+        with render_lock:
+            render_started = time.perf_counter()
+            renderer.close()
+        metrics.add_render_time(time.perf_counter() - render_started)
+        if stream is not None:
+            await stream.close()
+            if endpoint is not None:
+                get_endpoint_pool(url).finish(endpoint)
+            record_turn_metrics(metrics)
+        try:
+            loop.remove_signal_handler(signal.SIGINT)
+        except (NotImplementedError, RuntimeError):
+            pass
+    if cancelled:
+        console.print("[bold red]Response stopped[/bold red]")
+
+def get_async_loop():
+    """The event loop --async turns run on, kept across turns so their keep-alive connection survives"""
+    global async_loop
+    if async_loop is None:
+        async_loop = asyncio.new_event_loop()
+    return async_loop
+
+def run_async(coroutine):
+    """Run coroutine to completion on the shared loop, like asyncio.run without closing the loop"""
+    loop = get_async_loop()
+    task = loop.create_task(coroutine)
+    try:
+        return loop.run_until_complete(task)
+    except BaseException:
+        # e.g. KeyboardInterrupt where the loop has no SIGINT handler: do not leave the turn half-run
+        task.cancel()
+        loop.run_until_complete(asyncio.gather(task, return_exceptions=True))
+        raise
+
+def process_streaming_response_async(url, messages, temperature=0.4, max_tokens=8000):
+    """Asyncio counterpart of process_streaming_response (--async)"""
+    global stop_streaming
+    stop_streaming = False
+
+    payload = {
+        "messages": messages,
+        "temperature": temperature,
+        "max_output_tokens": max_tokens
+    }
+
+    try:
+        run_async(_stream_turn_async(url, messages, payload))
+    except asyncio.TimeoutError:
+        console.print("[bold red]Timed out waiting for the server[/bold red]")
+    except (OSError, ssl.SSLError) as e:
+        console.print(f"[bold red]Network error: {str(e)}[/bold red]")
+    except Exception as e:
+        console.print(f"[bold red]Error: {str(e)}[/bold red]")
+        import traceback
+        console.print(f"[dim]{traceback.format_exc()}[/dim]")
+
+
+class SessionJournal:
+    """
+    Append-only JSONL log of the session, written as messages land.
+
+    Each line is either a message ({"role", "content"}) or a control record
+    ({"op": "clear"} or {"op": "load", "file": ...}), flushed immediately so
+    a crash loses at most the message being streamed. read_journal() replays
+    it back into a history list.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None  # Opened on the first record so idle sessions leave no file behind
+
+    def write(self, record):
+        if self.file is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self.file = open(self.path, "a", encoding="utf-8")
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+def default_journal_path(name=None):
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    suffix = f"_{name}" if name else ""
+    return os.path.join(JOURNAL_DIR, f"session_{timestamp}_{os.getpid()}{suffix}.jsonl")
+
+def journal_record(record):
+    """Write a record to the session journal, disabling it on I/O errors"""
+    global journal
+    if journal is None:
+        return
+    try:
+        journal.write(record)
+    except OSError as e:
+        console.print(f"[red]Session journal disabled ({journal.path}): {e}[/red]")
+        journal = None
+
+class BlobStore:
+    """
+    Content-addressed store for large tool results.
+
+    Each blob is a UTF-8 file named by the SHA-256 of its text under
+    `directory`, so identical results are stored once. Recently used blobs
+    are kept in an in-memory LRU bounded to `cache_bytes`.
+    """
+
+    def __init__(self, directory, cache_bytes=64 * 1024 * 1024):
+        self.directory = directory
+        self.cache_bytes = cache_bytes
+        self._cache = OrderedDict()  # digest -> text
+        self._cached = 0
+
+    def path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def put(self, text):
+        """Store text and return its digest"""
+        data = text.encode("utf-8")
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp = f"{path}.{os.getpid()}.tmp"
+            with open(temp, "wb") as f:
+                f.write(data)
+            os.replace(temp, path)
+        self._remember(digest, text)
+        return digest
+
+    def get(self, digest):
+        """Text of a stored blob, or None if it is missing"""
+        text = self._cache.get(digest)
+        if text is not None:
+            self._cache.move_to_end(digest)
+            return text
+        try:
+            with open(self.path(digest), "r", encoding="utf-8") as f:
+                text = f.read()
+        except OSError:
+            return None
+        self._remember(digest, text)
+        return text
+
+    def _remember(self, digest, text):
+        if len(text) > self.cache_bytes or digest in self._cache:
+            return
+        self._cache[digest] = text
+        self._cached += len(text)
+        while self._cached > self.cache_bytes:
+            _, evicted = self._cache.popitem(last=False)
+            self._cached -= len(evicted)
+
+def get_blob_store():
+    """Return the shared blob store, creating it if needed"""
+    global blob_store
+    if blob_store is None:
+        blob_store = BlobStore(BLOB_DIR, blob_cache_bytes)
+    return blob_store
+
+def tool_result_message(content):
+    """
+    History entry for a tool result. Results over blob_threshold are written
+    to the blob store; history keeps a head/tail excerpt plus a reference
+    ("blob" digest and original "size").
+    """
+    if not blob_threshold or len(content) <= blob_threshold:
+        return {"role": "user", "content": content}
+    try:
+        digest = get_blob_store().put(content)
+    except OSError as e:
+        console.print(f"[yellow]Could not store large tool result out of line, keeping it in memory: {e}[/yellow]")
+        return {"role": "user", "content": content}
+    excerpt = excerpt_text(content, context_excerpt_chars, f"full result stored as blob {digest[:12]}")
+    return {"role": "user", "content": excerpt, "blob": digest, "size": len(content)}
+
+def resolve_tool_result(message, policy=None):
+    """The message as sent to the server under the tool result policy"""
+    digest = message.get("blob")
+    if not digest:
+        return message if isinstance(message, dict) else message.to_dict()
+    policy = policy or tool_result_policy
+    if policy == "full":
+        text = get_blob_store().get(digest)
+        if text is not None:
+            return {"role": message["role"], "content": text}
+        # Blob missing (e.g. a conversation saved on another machine): the excerpt is all there is
+    elif policy == "digest":
+        first_line = message["content"][len(TOOL_RESULT_PREFIX):].split("\n", 1)[0][:200]
+        return {"role": message["role"],
+                "content": f"{TOOL_RESULT_PREFIX}{first_line} [... {message.get('size', 0)} characters, sha256 {digest}, omitted ...]"}
+    return {"role": message["role"], "content": message["content"]}
+
+TOOL_RESULT_POLICIES = ("full", "excerpt", "digest")
+
+class StoredMessage(Mapping):
+    """
+    Compact, read-only history record.
+
+    The role is interned and the content kept as one UTF-8 bytes object
+    (as a str, ASCII text with a single emoji in it would take four bytes
+    per character); anything else, such as a blob reference, goes in
+    `extra`. It reads like the message dict it came from, decoding the
+    content on access.
+    """
+
+    __slots__ = ("role", "data", "extra")
+
+    def __init__(self, message):
+        self.role = sys.intern(message.get("role", ""))
+        content = message.get("content", "")
+        self.data = content.encode("utf-8") if isinstance(content, str) else None
+        extra = {k: v for k, v in message.items() if k != "role" and (k != "content" or self.data is None)}
+        self.extra = extra or None
+
+    def __getitem__(self, key):
+        if key == "role":
+            return self.role
+        if key == "content" and self.data is not None:
+            return self.data.decode("utf-8")
+        if self.extra is not None:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return key == "role" or (key == "content" and self.data is not None) or bool(self.extra and key in self.extra)
+
+    def __iter__(self):
+        yield "role"
+        if self.data is not None:
+            yield "content"
+        if self.extra:
+            yield from self.extra
+
+    def __len__(self):
+        return 1 + (self.data is not None) + len(self.extra or ())
+
+    def to_dict(self):
+        return dict(self)
+
+    def preview(self, chars):
+        """The first `chars` characters of the content, decoding only that much"""
+        if self.data is None:
+            return str(self.get("content", ""))[:chars]
+        return self.data[:chars * 4].decode("utf-8", errors="ignore")[:chars]
+
+class MessageStore(list):
+    """Conversation history holding StoredMessage records; dicts are converted as they are added"""
+
+    __slots__ = ()
+
+    def __init__(self, messages=()):
+        super().__init__(m if isinstance(m, StoredMessage) else StoredMessage(m) for m in messages)
+
+    def append(self, message):
+        super().append(message if isinstance(message, StoredMessage) else StoredMessage(message))
+
+    def extend(self, messages):
+        super().extend(m if isinstance(m, StoredMessage) else StoredMessage(m) for m in messages)
+
+def message_preview(message, chars):
+    """Start of a message's content without decoding all of a stored one"""
+    if isinstance(message, StoredMessage):
+        return message.preview(chars)
+    return str(message.get("content", ""))[:chars]
+
+def display_memory_report():
+    """Show what the conversation history and the client's caches hold in memory"""
+    history = conversation_history
+    mapped = 0
+    if isinstance(history, LazyConversation):
+        mapped = len(history) - len(history.appended)
+        history = history.appended
+    roles = {}
+    overhead = sys.getsizeof(history)
+    for message in history:
+        role = "tool" if is_tool_result(message) else message.get("role", "")
+        entry = roles.setdefault(role, [0, 0, 0])
+        entry[0] += 1
+        if isinstance(message, StoredMessage):
+            entry[1] += len(message.data or b"")
+            overhead += sys.getsizeof(message) + sys.getsizeof(message.data) - len(message.data or b"")
+        else:
+            entry[1] += len(message.get("content", "").encode("utf-8"))
+            overhead += sys.getsizeof(message)
+        if message.get("blob"):
+            entry[2] += message.get("size", 0)
+
+    table = Table(box=box.SIMPLE, show_edge=False)
+    table.add_column("Role")
+    table.add_column("Messages", justify="right")
+    table.add_column("Content KB", justify="right")
+    table.add_column("Out of line KB", justify="right")
+    for role, (count, size, stored) in sorted(roles.items(), key=lambda item: -item[1][1]):
+        table.add_row(role, str(count), f"{size / 1024:.1f}", f"{stored / 1024:.1f}" if stored else "-")
+    table.add_row("[bold]total[/bold]", str(sum(e[0] for e in roles.values())),
+                  f"{sum(e[1] for e in roles.values()) / 1024:.1f}", f"{sum(e[2] for e in roles.values()) / 1024:.1f}")
+    console.print(table)
+    mapped_note = f"; {mapped} more messages memory-mapped from {conversation_history.filename}" if mapped else ""
+    console.print(f"[dim]Record overhead: {overhead / 1024:.1f} KB{mapped_note}[/dim]")
+    blob_kb = blob_store._cached / 1024 if blob_store is not None else 0
+    buffered = sum(session.unseen for session in sessions.values())
+    console.print(f"[dim]Caches: {len(panel_cache)} history panels, {len(syntax_cache)} highlighted code blocks, "
+                  f"{blob_kb:.0f} KB of tool result blobs, {buffered} buffered background events[/dim]")
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak_mb = peak / 1048576 if sys.platform == "darwin" else peak / 1024  # Bytes on macOS, KB elsewhere
+        console.print(f"[dim]Peak process memory (RSS): {peak_mb:.1f} MB[/dim]")
+    except ImportError:
+        pass
+
+def record_message(message):
+    """Append a message to the conversation history and the session journal"""
+    conversation_history.append(message)
+    journal_record(message)
+
+def read_journal(filename, _depth=0):
+    """Replay a JSONL journal into a list of messages"""
+    messages = []
+    with open(filename, 'r', encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # A crash can leave a torn final line; everything before it is intact
+                break
+            op = record.get("op")
+            if op == "clear":
+                messages = []
+            elif op == "load" and _depth < 8:
+                # The file may have grown since (e.g. saved to again), so take only what was loaded
+                messages = read_conversation_file(record["file"], _depth + 1)[:record.get("count")]
+            elif "role" in record:
+                messages.append(record)
+    return messages
+
+def read_conversation_file(filename, _depth=0):
+    """Read a saved conversation (JSON array) or a session journal (JSONL)"""
+    if filename.endswith(".jsonl"):
+        return read_journal(filename, _depth)
+    with open(filename, 'r') as f:
+        return json.load(f)
+
+# Tokens that matter when locating top-level objects in a JSON array, and the rest of a string
+_JSON_STRUCTURE_RE = re.compile(rb'[{}\[\]"]')
+_JSON_STRING_TAIL_RE = re.compile(rb'[^"\\]*(?:\\.[^"\\]*)*"', re.S)
+
+def index_json_array(buf, offset=0):
+    """
+    Byte spans of each top-level object in a JSON array, without decoding them.
+    A nonzero offset must be the end of a top-level object; scanning resumes there.
+    """
+    if buf[:5] == b"[\n  {":
+        # Written with indent=2 (json.dump or save_conversation): raw newlines never occur
+        # inside JSON strings, so a line holding just "  }" always closes a top-level object
+        return _index_indented_json_array(buf, offset)
+    spans = []
+    depth = 1 if offset else 0
+    start = 0
+    pos = offset
+    search = _JSON_STRUCTURE_RE.search
+    match_string = _JSON_STRING_TAIL_RE.match
+    while True:
+        token = search(buf, pos)
+        if token is None:
+            break
+        char = token.group()
+        pos = token.end()
+        if char == b'"':
+            end = match_string(buf, pos)
+            if end is None:
+                raise ValueError("Unterminated string in JSON array")
+            pos = end.end()
+        elif char in b"{[":
+            depth += 1
+            if depth == 2:
+                start = token.start()
+        else:
+            depth -= 1
+            if depth == 1:
+                spans.append((start, pos))
+    if depth != 0:
+        raise ValueError("Truncated JSON array")
+    return spans
+
+def _index_indented_json_array(buf, pos=0):
+    spans = []
+    find = buf.find
+    while True:
+        start = find(b"{", pos)
+        if start == -1:
+            break
+        end = find(b"\n  }", start)
+        if end == -1:
+            raise ValueError("Truncated JSON array")
+        pos = end + 4
+        spans.append((start, pos))
+    return spans
+
+def index_jsonl(buf):
+    """Byte spans of each non-empty line, or None if the file holds journal control records"""
+    spans = []
+    pos = 0
+    size = len(buf)
+    find = buf.find
+    while pos < size:
+        end = find(b"\n", pos)
+        if end == -1:
+            end = size
+        if buf[pos:pos + 6] == b'{"op":':
+            return None
+        if end > pos:
+            spans.append((pos, end))
+        pos = end + 1
+    return spans
+
+class LazyConversation:
+    """
+    Conversation history backed by a memory-mapped saved file.
+
+    An offset index over the file is built up front; individual messages are
+    decoded only when accessed (with a small LRU cache), so loading a huge
+    transcript neither parses nor holds it all in memory. Messages added
+    after loading live in an ordinary list behind the file-backed ones.
+    """
+
+    def __init__(self, filename, buf, spans):
+        self.filename = filename
+        self._buf = buf
+        self._spans = spans
+        self._appended = MessageStore()
+        self._cache = OrderedDict()
+
+    @classmethod
+    def open(cls, filename):
+        """Index filename, returning None when it cannot be read lazily"""
+        with open(filename, "rb") as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            spans = index_jsonl(buf) if filename.endswith(".jsonl") else index_json_array(buf)
+        except ValueError as e:
+            buf.close()
+            raise json.JSONDecodeError(str(e), filename, 0)
+        if spans is None:
+            buf.close()
+            return None
+        return cls(filename, buf, spans)
+
+    def __len__(self):
+        return len(self._spans) + len(self._appended)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if index >= len(self._spans):
+            return self._appended[index - len(self._spans)]
+        message = self._cache.get(index)
+        if message is None:
+            start, end = self._spans[index]
+            message = json.loads(self._buf[start:end])
+            self._cache[index] = message
+            if len(self._cache) > 256:
+                self._cache.popitem(last=False)
+        else:
+            self._cache.move_to_end(index)
+        return message
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def append(self, message):
+        self._appended.append(message)
+
+    @property
+    def appended(self):
+        """Messages added after loading"""
+        return self._appended
+
+    def stored_tool_result(self, index):
+        """
+        Whether a file-backed message is a tool result, read from its raw bytes
+        without decoding it; None when that cannot be told (appended messages,
+        unusual formatting).
+        """
+        if index >= len(self._spans):
+            return None
+        start, end = self._spans[index]
+        find = self._buf.find
+        if find(b'"' + TOOL_RESULT_PREFIX_BYTES, start, end) == -1:
+            return False
+        # Quotes inside JSON strings are escaped, so these can only be the message's own keys
+        if ((find(b'"content": "' + TOOL_RESULT_PREFIX_BYTES, start, end) != -1
+                or find(b'"content":"' + TOOL_RESULT_PREFIX_BYTES, start, end) != -1)
+                and (find(b'"role": "user"', start, end) != -1 or find(b'"role":"user"', start, end) != -1)):
+            return True
+        return None
+
+    def stored_size(self, index):
+        """Encoded size in bytes of a file-backed message (0 for appended ones)"""
+        if index < len(self._spans):
+            start, end = self._spans[index]
+            return end - start
+        return 0
+
+def open_conversation_file(filename):
+    """Load a conversation, memory-mapping it when it is large enough to matter"""
+    if os.path.getsize(filename) >= lazy_load_threshold:
+        history = LazyConversation.open(filename)
+        if history is not None:
+            return history
+    return MessageStore(read_conversation_file(filename))
+
+def _saved_entry(message):
+    """One message formatted exactly as json.dump(..., indent=2) writes it inside the array"""
+    if isinstance(message, StoredMessage):
+        message = message.to_dict()
+    return "  " + json.dumps(message, indent=2).replace("\n", "\n  ")
+
+def save_conversation(filename=None):
+    """
+    Save the conversation history to a file.
+
+    Saving the same history to the same file again only appends the messages
+    added since the last save, keeping the output identical to a full
+    json.dump(..., indent=2) rewrite. A background turn may append messages
+    while the file is written, so the save covers the messages there were
+    when it started and the rest go out with the next one.
+    """
+    global last_save
+    history = conversation_history
+    count = len(history)
+    if filename is None:
+        if last_save and last_save[0] is conversation_history:
+            filename = last_save[1]
+        else:
+            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            filename = f"conversation_{timestamp}.json"
+
+    appended = False
+    if last_save and last_save[0] is history and last_save[1] == filename and last_save[2]:
+        try:
+            unchanged = os.path.getsize(filename) == last_save[3]
+        except OSError:
+            unchanged = False
+        if unchanged:
+            new_messages = history[last_save[2]:count]
+            with open(filename, 'r+b') as f:
+                # Drop the closing "\n]" and continue the array in place
+                f.seek(last_save[3] - 2)
+                f.truncate()
+                if new_messages:
+                    f.write((",\n" + ",\n".join(_saved_entry(m) for m in new_messages)).encode("utf-8"))
+                f.write(b"\n]")
+            appended = True
+
+    if not appended:
+        # Written entry by entry (same output as json.dump(..., indent=2)) so a
+        # lazily loaded history is streamed rather than materialized. The
+        # output goes to a temporary file that then replaces the target, as
+        # the history may be memory-mapped from the file being overwritten.
+        temp_name = f"{filename}.{os.getpid()}.tmp"
+        try:
+            with open(temp_name, 'w') as f:
+                if count:
+                    f.write("[\n")
+                    for i in range(count):
+                        f.write((",\n" if i else "") + _saved_entry(history[i]))
+                    f.write("\n]")
+                else:
+                    f.write("[]")
+            os.replace(temp_name, filename)
+        except BaseException:
+            if os.path.exists(temp_name):
+                os.remove(temp_name)
+            raise
+
+    last_save = (history, filename, count, os.path.getsize(filename))
+    console.print(f"[green]Conversation saved to {filename}[/green]")
+    index_conversation_file(filename)
+
+def load_conversation(filename):
+    """Load a conversation history from a file"""
+    global conversation_history
+    
+    try:
+        conversation_history = open_conversation_file(filename)
+        journal_record({"op": "load", "file": os.path.abspath(filename), "count": len(conversation_history)})
+        lazy_note = " (memory-mapped, messages are read on demand)" if isinstance(conversation_history, LazyConversation) else ""
+        console.print(f"[green]Loaded {len(conversation_history)} messages from {filename}{lazy_note}[/green]")
+        
+        # Display the tail of the loaded conversation
+        display_conversation_history(last=history_tail)
+    except FileNotFoundError:
+        console.print(f"[red]File not found: {filename}[/red]")
+    except json.JSONDecodeError:
+        console.print(f"[red]Invalid JSON format in file: {filename}[/red]")
+
+def render_message_panel(index, message):
+    """Build the history panel for one message (None for roles that are not shown)"""
+    role = message.get("role", "")
+    content = message.get("content", "")
+    number = f" [dim]#{index}[/dim]"
     
-    for line in text.split("\n"):
-        if line.startswith("```"):
-            if in_code_block:
-                # End of code block
-                if code_content:
-                    syntax = Syntax(code_content.strip(), code_language or "text", theme="monokai", line_numbers=True)
-                    parts.append(syntax)
-                in_code_block = False
-                code_content = ""
-                code_language = ""
+    if role == "user":
+        return Panel(content, title="User" + number, border_style="green", box=box.ROUNDED)
+    elif role == "assistant":
+        final_content = Markdown(content)
+        return Panel(final_content, title="Assistant" + number, border_style="violet", box=box.ROUNDED)
+    elif role == "system":
+        return Panel(content, title="System" + number, border_style="yellow", box=box.ROUNDED)
+    return None
+
+def cached_message_segments(index, message):
+    """Rendered segments for a history panel, reused while content and terminal width are unchanged"""
+    content = message.get("content", "")
+    key = (index, message.get("role", ""), hash(content), len(content), console.width)
+    segments = panel_cache.get(key)
+    if segments is None:
+        panel = render_message_panel(index, message)
+        segments = list(console.render(panel)) if panel is not None else []
+        panel_cache[key] = segments
+        if len(panel_cache) > panel_cache_size:
+            panel_cache.popitem(last=False)
+    else:
+        panel_cache.move_to_end(key)
+    return segments
+
+def display_messages(start, end):
+    """Print history panels for messages[start:end]; only this window is decoded and rendered"""
+    for index in range(start, end):
+        segments = cached_message_segments(index, conversation_history[index])
+        if segments:
+            console.print(Segments(segments))
+
+def display_conversation_history(last=None):
+    """Display the current conversation history, or only its last few messages"""
+    start = 0
+    if last is not None and len(conversation_history) > last:
+        start = len(conversation_history) - last
+        console.print(f"[dim]Showing the last {last} of {len(conversation_history)} messages. Use /history \\[page] to see older ones.[/dim]")
+    display_messages(start, len(conversation_history))
+
+def display_history_page(page=None):
+    """Show one page of history; pages count from 1 (oldest), default is the latest page"""
+    total = len(conversation_history)
+    if total == 0:
+        console.print("[yellow]Conversation history is empty[/yellow]")
+        return
+    pages = (total + history_page_size - 1) // history_page_size
+    page = pages if page is None else max(1, min(page, pages))
+    start = (page - 1) * history_page_size
+    end = min(start + history_page_size, total)
+    display_messages(start, end)
+    console.print(f"[dim]History page {page}/{pages} (messages {start}-{end - 1} of {total}). "
+                  f"/history \\[page], /history --last N, /history --search text[/dim]")
+
+def search_history(term):
+    """Jump to the page holding the newest match; repeating the search steps to older matches"""
+    global history_search
+    needle = term.lower()
+    before = len(conversation_history)
+    if history_search and history_search[0] == needle:
+        before = history_search[1]
+    for index in range(before - 1, -1, -1):
+        if needle in conversation_history[index].get("content", "").lower():
+            history_search = (needle, index)
+            console.print(f"[green]Match in message #{index}[/green]")
+            display_history_page(index // history_page_size + 1)
+            return
+    history_search = None
+    console.print(f"[yellow]No {'older ' if before < len(conversation_history) else ''}messages matching '{term}'[/yellow]")
+
+def handle_history_command(args):
+    """/history [page] | /history --last N | /history --search text"""
+    try:
+        if not args:
+            display_history_page()
+        elif args[0] == "--last":
+            display_conversation_history(last=int(args[1]) if len(args) > 1 else history_page_size)
+        elif args[0] == "--search":
+            if len(args) > 1:
+                search_history(" ".join(args[1:]))
             else:
-                # Start of code block
-                in_code_block = True
-                code_language = line[3:].strip()
-        elif in_code_block:
-            code_content += line + "\n"
+                console.print("[red]Error: Please specify text to search for[/red]")
         else:
-            parts.append(line)
-    
-    return parts
+            display_history_page(int(args[0]))
+    except ValueError:
+        console.print("[red]Usage: /history \\[page] | /history --last N | /history --search text[/red]")
 
-def format_tool_result(result):
-    """Format tool call results using markdown"""
+class SearchIndex:
+    """
+    Incremental SQLite FTS5 index over saved conversations and session journals.
 
-    try:
-        # Clean up the result
-        if result.startswith("Tool result: "):
-            result = result[len("Tool result: "):]
-        
-        if len(result) >= 200:
-            result = result[:180] + "... ```"
+    Each message is indexed with the byte span it occupies in its file, so a
+    hit is shown by reading just that span. Files are tracked by size and
+    mtime; a file that only grew since it was last indexed (journals, and
+    saves that append) has just its new messages added, as long as the last
+    indexed message is still where it was. Anything else is reindexed.
+    """
 
-        # If it looks like structured data, format it nicely
-        if "```" in result:
-            # It already has markdown code blocks, just return as markdown
-            return Markdown(result)
-        
-        # For plain text results, add some light markdown formatting
-        # You could add logic here to detect different types of content
-        if result.strip().startswith('{') and result.strip().endswith('}'):
-            # Looks like JSON, wrap in a code block
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS files (id INTEGER PRIMARY KEY, path TEXT UNIQUE, size INTEGER,"
+                            " mtime REAL, count INTEGER, tail_start INTEGER, tail_end INTEGER, tail_hash TEXT)")
+            self.db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS messages USING fts5(content, role UNINDEXED,"
+                            " file UNINDEXED, position UNINDEXED, start UNINDEXED, end UNINDEXED)")
+
+    @staticmethod
+    def _spans(buf, journal, offset):
+        """Spans of complete messages (JSON objects or JSONL lines) ending after offset"""
+        if not journal:
+            return index_json_array(buf, offset)
+        spans = []
+        pos = offset
+        find = buf.find
+        while True:
+            end = find(b"\n", pos)
+            if end == -1:
+                break  # A line still being written is picked up next time
+            if end > pos:
+                spans.append((pos, end))
+            pos = end + 1
+        return spans
+
+    def update(self, path):
+        """Index what is new in one file; returns the number of messages added"""
+        path = os.path.abspath(path)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            self.forget(path)
+            return 0
+        with self._lock:
+            row = self.db.execute("SELECT id, size, mtime, count, tail_start, tail_end, tail_hash FROM files WHERE path = ?",
+                                  (path,)).fetchone()
+            if row and row[1] == stat.st_size and row[2] == stat.st_mtime:
+                return 0
+            if stat.st_size == 0:
+                return 0
+            with open(path, "rb") as f:
+                buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                return self._index(path, row, stat, buf)
+            finally:
+                buf.close()
+
+    def _index(self, path, row, stat, buf):
+        journal = path.endswith(".jsonl")
+        file_id, count, offset = (row[0], row[3], row[5]) if row else (None, 0, 0)
+        appended = (row is not None and row[5] <= len(buf)
+                    and hashlib.sha256(buf[row[4]:row[5]]).hexdigest() == row[6])
+        if not appended:
+            count, offset = 0, 0
+        try:
+            spans = self._spans(buf, journal, offset)
+        except ValueError:
+            return 0  # Caught mid-write; the next update picks it up
+        tail = (row[4], row[5], row[6]) if appended else (0, 0, "")
+        rows = []
+        for start, end in spans:
             try:
-                parsed = json.loads(result)
-                formatted = json.dumps(parsed, indent=2)
-                return Markdown(f"```json\n{formatted}\n```")
+                message = json.loads(buf[start:end])
             except json.JSONDecodeError:
-                pass
+                continue
+            if not isinstance(message, dict) or "role" not in message:
+                continue  # Journal control records
+            rows.append((str(message.get("content", "")), message["role"], start, end, count))
+            count += 1
+        if spans:
+            tail = (spans[-1][0], spans[-1][1], hashlib.sha256(buf[spans[-1][0]:spans[-1][1]]).hexdigest())
+        with self.db:
+            if file_id is None:
+                file_id = self.db.execute("INSERT INTO files (path) VALUES (?)", (path,)).lastrowid
+            elif not appended:
+                self.db.execute("DELETE FROM messages WHERE file = ?", (file_id,))
+            self.db.executemany("INSERT INTO messages (content, role, file, start, end, position) VALUES (?, ?, ?, ?, ?, ?)",
+                                [(content, role, file_id, start, end, position) for content, role, start, end, position in rows])
+            self.db.execute("UPDATE files SET size = ?, mtime = ?, count = ?, tail_start = ?, tail_end = ?, tail_hash = ?"
+                            " WHERE id = ?", (stat.st_size, stat.st_mtime, count) + tail + (file_id,))
+        return len(rows)
 
-        # For regular messages, just return as markdown (handles basic formatting)
-        return Markdown(result)
-        
-    except Exception as e:
-        return Markdown(f"**Error formatting tool result:** {str(e)}\n\n```\n{result}\n```")
-    
+    def forget(self, path):
+        with self._lock, self.db:
+            row = self.db.execute("SELECT id FROM files WHERE path = ?", (path,)).fetchone()
+            if row:
+                self.db.execute("DELETE FROM messages WHERE file = ?", (row[0],))
+                self.db.execute("DELETE FROM files WHERE id = ?", (row[0],))
 
-def process_streaming_response(url, messages, temperature=0.4, max_tokens=8000):
-    """Process streaming response from the API"""
-    global stop_streaming
-    stop_streaming = False
-    
-    payload = {
-        "messages": messages,
-        "temperature": temperature,
-        "max_output_tokens": max_tokens
-    }
-    
+    def refresh(self, paths=()):
+        """Bring every known file, plus `paths`, up to date; returns messages added"""
+        known = [row[0] for row in self.db.execute("SELECT path FROM files")]
+        return sum(self.update(path) for path in dict.fromkeys(known + [os.path.abspath(p) for p in paths]))
+
+    def search(self, text, limit=20):
+        """Best matches for the words in text as (path, position, role, start, end, snippet)"""
+        # Every word is quoted, so punctuation in the query is never read as FTS5 syntax
+        query = " ".join('"' + word.replace('"', '""') + '"' for word in text.split())
+        if not query:
+            return []
+        with self._lock:
+            return self.db.execute(
+                "SELECT files.path, messages.position, messages.role, messages.start, messages.end,"
+                " snippet(messages, 0, char(2), char(3), '…', 16)"
+                " FROM messages JOIN files ON files.id = messages.file"
+                " WHERE messages MATCH ? ORDER BY rank LIMIT ?", (query, limit)).fetchall()
+
+def get_search_index():
+    """Return the shared search index, opening it if needed (None if SQLite FTS5 is unavailable)"""
+    global search_index
+    if search_index is None:
+        try:
+            search_index = SearchIndex(SEARCH_DB)
+        except (sqlite3.Error, OSError) as e:
+            console.print(f"[yellow]Conversation search is unavailable: {e}[/yellow]")
+            search_index = False
+    return search_index or None
+
+def index_conversation_file(path):
+    """Add a conversation file's new messages to the search index as it is written"""
+    index = get_search_index()
+    if index is not None:
+        try:
+            index.update(path)
+        except (sqlite3.Error, OSError) as e:
+            console.print(f"[yellow]Could not index {path} for search: {e}[/yellow]")
+
+def conversation_files():
+    """Saved conversations in the working directory and session journals"""
+    files = [entry.path for entry in os.scandir(".")
+             if entry.name.startswith("conversation_") and entry.name.endswith(".json")]
+    if os.path.isdir(JOURNAL_DIR):
+        files += [entry.path for entry in os.scandir(JOURNAL_DIR) if entry.name.endswith(".jsonl")]
+    return files
+
+def search_conversations(text):
+    """Index new conversation files, then list the best matches for text"""
+    global search_results
+    index = get_search_index()
+    if index is None:
+        return
+    with Status(Padding("[dim]Updating search index...[/dim]", (0, 0, 0, 4)), console=console):
+        index.refresh(conversation_files())
+    search_results = index.search(text)
+    if not search_results:
+        console.print(f"[yellow]No saved messages matching '{text}'[/yellow]")
+        return
+    table = Table(box=box.SIMPLE, show_edge=False)
+    table.add_column("#", justify="right")
+    table.add_column("Conversation")
+    table.add_column("Msg", justify="right")
+    table.add_column("Role")
+    table.add_column("Match")
+    for number, (path, position, role, _, _, snippet) in enumerate(search_results, 1):
+        match = escape(" ".join(snippet.split())).replace("\x02", "[bold yellow]").replace("\x03", "[/bold yellow]")
+        table.add_row(str(number), os.path.basename(path), str(position), role, match)
+    console.print(table)
+    console.print("[dim]/search show N to read a match, /search open N to load its conversation[/dim]")
+
+def read_search_hit(number):
+    """(path, position, message) for hit N of the last search, read straight from its byte span"""
+    if not 1 <= number <= len(search_results):
+        console.print(f"[red]No search result {number}[/red]")
+        return None
+    path, position, _, start, end, _ = search_results[number - 1]
     try:
-        assistant_message = ""
-#        full_response = []
-        current_role = ""
-        current_live = None
-        
-        # Show a message while waiting for the first response
-        # console.print(Padding("[dim]Waiting for response...[/dim]",(0, 0, 0, 4)))
+        with open(path, "rb") as f:
+            f.seek(start)
+            return path, position, json.loads(f.read(end - start))
+    except (OSError, json.JSONDecodeError):
+        console.print(f"[red]{path} has changed since it was indexed; search again[/red]")
+        return None
 
-        with Status(Padding("[dim]Waiting for response...[/dim]", (0, 0, 0, 4)), console=console):
-            # Set up streaming request inside the status context
-            response = requests.post(url, json=payload, stream=True, headers={'Accept': 'text/event-stream'})
+def handle_search_command(args):
+    """/search text | /search show N | /search open N"""
+    if not args:
+        console.print("[red]Usage: /search text | /search show N | /search open N[/red]")
+        return
+    if args[0] in ("show", "open") and len(args) == 2 and args[1].isdigit():
+        hit = read_search_hit(int(args[1]))
+        if hit is None:
+            return
+        path, position, message = hit
+        if args[0] == "show":
+            console.print(f"[dim]{path}, message {position}[/dim]")
+            panel = render_message_panel(position, message)
+            console.print(panel if panel is not None else message.get("content", ""))
+            return
+        load_conversation(path)
+        # Journals replay clears and loads, so the position in the file may not be the position in the history
+        content = message.get("content")
+        if not (position < len(conversation_history) and conversation_history[position].get("content") == content):
+            position = next((i for i in range(len(conversation_history) - 1, -1, -1)
+                             if conversation_history[i].get("content") == content), None)
+        if position is not None:
+            console.print(f"[green]Match in message #{position}[/green]")
+            display_history_page(position // history_page_size + 1)
+        return
+    search_conversations(" ".join(args))
 
-        console.print("")
-    
-        def start_assistant_live():
-            """Start a new Live component for assistant responses"""
-            live = Live(
-                Padding(Markdown(""), (0, 0, 0, 4)), 
-                refresh_per_second=10, 
-                console=console
-            )
-            live.start()
-            return live
-        
-        def start_tool_live():
-            """Start a new Live component for tool responses"""
-            live = Live(
-                Padding("", (0, 0, 0, 4)), 
-                refresh_per_second=10, 
-                console=console
-            )
-            live.start()
-            return live
-        
-        def finalize_assistant_live(live, message):
-            """Finalize assistant Live with a Panel"""
-            if message:
-                final_content = Markdown(message)
-                final_panel = Panel(
-                    final_content, 
-                    title="Assistant", 
-                    border_style="violet", 
-                    box=box.ROUNDED
-                )
-                live.update(Padding(final_panel, (0, 4, 0, 4)))
-            conversation_history.append({"role": "assistant", "content": message})
+class TurnCollector:
+    """
+    Accumulates one turn's stream events into messages without rendering.
 
-            live.stop()
-        
-        def finalize_tool_live(live, content):
-            """Finalize tool Live with a Panel"""
-            formatted_result = format_tool_result(content)
-            final_panel = Panel(
-                formatted_result, 
-                title="Tool Result", 
-                border_style="cyan",
-                box=box.ROUNDED
-            )
-            live.update(Padding(final_panel, (0, 4, 0, 4)))
-            live.stop()
+    Follows the same rules as StreamRenderer: assistant chunks are joined
+    into one message per assistant segment, and each tool_call becomes a
+    user message carrying the tool result, built by `tool_message` when given.
+    """
 
+    def __init__(self, tool_message=None):
+        self.tool_message = tool_message
+        self.messages = []
+        self.tool_calls = []
+        self.events = 0
+        self._role = ""
+        self._parts = []
 
-        try:
-            for chunk in response.iter_lines(decode_unicode=True):
-                if stop_streaming:
-                    break
-                
-                if not chunk:
-                    continue
-                
+    def handle(self, event):
+        self.events += 1
+        role = event.role
+        if role != self._role:
+            self._flush()
+            self._role = role
+        if role == 'assistant' and event.type == 'chunk':
+            self._parts.append(event.content)
+        elif role == 'tool_call':
+            content = event.content
+            self.messages.append(self.tool_message(content) if self.tool_message else {"role": "user", "content": content})
+            self.tool_calls.append(content)
+
+    def _flush(self):
+        if self._role == 'assistant':
+            self.messages.append({"role": "assistant", "content": "".join(self._parts)})
+            self._parts = []
+
+    def close(self):
+        self._flush()
+        self._role = ""
+
+    @property
+    def response(self):
+        """Text of the last assistant message"""
+        for message in reversed(self.messages):
+            if message["role"] == "assistant":
+                return message["content"]
+        return ""
+
+class ChatSession:
+    """
+    One conversation: its history and input state, plus a turn that may be
+    streaming in the background.
+
+    The foreground session's state lives in the module globals the rest of
+    the client works with (conversation_history, journal, ...); activate()
+    and suspend() move it in and out of `state`. A background turn runs in
+    a worker thread over the shared transport: it collects finished
+    messages straight into the session's history and journal, and keeps the
+    decoded events in `events` without rendering them until the session is
+    followed in the foreground. The worker is handed those objects when the
+    turn starts rather than looking them up, since the session can move in
+    or out of the globals at any point while it runs (nothing replaces them
+    meanwhile: /clear, /load and /bg are refused while a turn runs).
+    """
+
+    STATE = ("conversation_history", "multiline_mode", "journal", "last_save", "history_search", "delta_session")
+
+    def __init__(self, name, journal=None):
+        self.name = name
+        self.state = {"conversation_history": MessageStore(), "multiline_mode": False, "journal": journal,
+                      "last_save": None, "history_search": None,
+                      "delta_session": DeltaSession() if delta_session is not None else None}
+        self.events = []  # Decoded events of the background turn
+        self.shown = 0  # How many of them have been rendered
+        self.worker = None
+        self.response = None
+        self.stop = False
+        self.following = False
+        self.error = None
+        self.started = None
+        self.tools_shown = 0  # Number of the last tool result rendered in the foreground
+        self._cond = threading.Condition()
+
+    def get(self, field):
+        return globals()[field] if self is current_session else self.state[field]
+
+    def activate(self):
+        globals().update(self.state)
+
+    def suspend(self):
+        self.state = {field: globals()[field] for field in self.STATE}
+
+    @property
+    def running(self):
+        return self.worker is not None and self.worker.is_alive()
+
+    @property
+    def unseen(self):
+        return len(self.events) - self.shown
+
+    def add_events(self, events):
+        with self._cond:
+            self.events.extend(events)
+            self._cond.notify_all()
+
+    def wait_events(self, timeout):
+        """Wait for events not rendered yet; returns (events, still running)"""
+        with self._cond:
+            if self.shown == len(self.events) and self.running:
+                self._cond.wait(timeout)
+            return self.events[self.shown:], self.running
+
+    @staticmethod
+    def save_messages(messages, history, journal):
+        """Append finished messages of the background turn to the session's history and journal"""
+        for message in messages:
+            history.append(message)
+            if journal is not None:
                 try:
-                    data = json.loads(chunk)
-                    role = data.get('role', '')
-                    content = data.get('content', '')
-                    msg_type = data.get('type', '')
-
-                    # Handle role transitions
-                    if current_role != role:
-                        # Finish previous Live component
-                        if current_live:
-                            if current_role == 'assistant':
-                                finalize_assistant_live(current_live, assistant_message)
-                            elif current_role == 'tool_call':
-                                # Tool content should already be handled
-                                current_live.stop()
-                        
-                        # Start new Live component
-                        if role == 'assistant':
-                            current_live = start_assistant_live()
-                            assistant_message = ""  # Reset for new assistant message
-                        elif role == 'tool_call':
-                            current_live = start_tool_live()
-                        
-                        current_role = role
-
-                    # Handle content based on role
-                    if role == 'assistant':
-                        if msg_type == 'chunk':
-                            assistant_message += content
-                            # Update the live assistant display
-                            md = Markdown(assistant_message)
-                            current_live.update(Padding(md, (0, 0, 0, 4)))
-                        
-                        elif msg_type == 'done':
-                            # This will be handled by role transition or final cleanup
-                            pass
-                            
-                    elif role == 'tool_call':
-                        # Handle tool call immediately and finalize
-                        finalize_tool_live(current_live, content)
-                        current_live = None  # Will be reset on next role transition
-                        
-                        # Store in conversation history
- #                       full_response.append({"role": "tool", "content": content})
-                        conversation_history.append({"role": "user", "content": content})
-
-                except json.JSONDecodeError as e:
-                    if chunk and len(chunk) > 0:
-                        console.print(f"[red]Error parsing JSON: {e}[/red]\n[dim]Raw data: {chunk}[/dim]")
+                    journal.write(message)
+                except OSError:
+                    pass
 
+    def start_turn(self, url, messages, temperature, max_tokens):
+        self.events = []
+        self.shown = 0
+        self.stop = False
+        self.error = None
+        self.started = time.monotonic()
+        self.tools_shown = count_tool_results()  # Started from the foreground, so the globals are this session's
+        targets = (self.get("conversation_history"), self.get("journal"), self.get("delta_session"))
+        self.worker = threading.Thread(target=self._run_turn, args=(url, messages, temperature, max_tokens, *targets), daemon=True)
+        self.worker.start()
+
+    def _run_turn(self, url, messages, temperature, max_tokens, history, journal, delta):
+        payload = {
+            "messages": messages,
+            "temperature": temperature,
+            "max_output_tokens": max_tokens
+        }
+        collector = TurnCollector(tool_message=tool_result_message)
+        metrics = TurnMetrics(url)
+        response = endpoint = recorded = None
+        saved = 0
+        try:
+            cache_key, replay = lookup_cached_response(url, messages, temperature, max_tokens)
+            if replay is not None:
+                batches = [replay.splitlines()]
+                metrics.url = "cache"
+            else:
+                response, endpoint = open_chat_stream(url, messages, payload, delta)
+                self.response = response
+                metrics.url = endpoint.url
+                batches = get_transport().iter_line_batches(response)
+                recorded = [] if cache_key else None
+            metrics.response_started()
+            decoder = get_stream_decoder()
+            for lines in batches:
+                if recorded is not None:
+                    recorded.extend(lines)
+                events = decoder.decode_batch(lines)
+                for event in events:
+                    if not event.error:
+                        metrics.event(event)
+                        collector.handle(event)
+                self.save_messages(collector.messages[saved:], history, journal)
+                saved = len(collector.messages)
+                self.add_events(events)
+                if self.stop:
+                    break
+            if recorded is not None and not self.stop:
+                response_cache.put(cache_key, recorded)
+        except Exception as e:
+            if not self.stop:
+                self.error = f"{type(e).__name__}: {e}"
         finally:
-            # Clean up any remaining Live component
-            if current_live:
-                if current_role == 'assistant':
-                    finalize_assistant_live(current_live, assistant_message)
+            collector.close()
+            self.save_messages(collector.messages[saved:], history, journal)
+            if response is not None:
+                response.close()
+                get_endpoint_pool(url).finish(endpoint)
+            self.response = None
+            record_turn_metrics(metrics)
+            if journal is not None:
+                index_conversation_file(journal.path)
+            with self._cond:
+                self._cond.notify_all()
+            if not self.following:
+                outcome = f"failed ({self.error})" if self.error else "finished"
+                console.print(f"\n[dim]Session {self.name} {outcome}; /session switch {self.name} to see it[/dim]")
+
+    def cancel(self):
+        """Stop the background turn, cutting off its stream"""
+        self.stop = True
+        response = self.response
+        if response is not None:
+            ChatTransport.abort(response)
+
+def follow_session(session):
+    """Render a session's background events in the foreground; Ctrl+C leaves it streaming"""
+    if not session.unseen and not session.running:
+        return
+    session.following = True
+    renderer = StreamRenderer(record=False, tool_number=session.tools_shown)
+    try:
+        while True:
+            events, running = session.wait_events(0.1)
+            for event in events:
+                if event.error:
+                    console.print(f"[red]{event.error}[/red]\n[dim]Raw data: {event.content}[/dim]")
                 else:
-                    current_live.stop()
-        
+                    renderer.handle(event)
+                session.shown += 1
+            if not events and not running:
+                break
+    except KeyboardInterrupt:
+        console.print(f"\n[yellow]Session {session.name} keeps streaming in the background[/yellow]")
+    finally:
+        renderer.close()
+        session.tools_shown = renderer.tool_number
+        session.following = False
+    if not session.running:
+        if session.error:
+            console.print(f"[bold red]Error: {session.error}[/bold red]")
+        # Everything has been seen, so the buffered events can go
+        session.events = []
+        session.shown = 0
 
-        
-        # If we got no response at all
-#        if not assistant_message and not full_response:
-        if not assistant_message:
-            console.print("[yellow]No response received from the server. You might need to check API connectivity or server logs.[/yellow]")
-            # Add a debug option for investigating response format
-            console.print("[dim]Try setting debug_mode=True in the script to see raw response data.[/dim]")
-            
-    except requests.RequestException as e:
-        console.print(f"[bold red]Network error: {str(e)}[/bold red]")
-    except Exception as e:
-        console.print(f"[bold red]Error: {str(e)}[/bold red]")
-        import traceback
-        console.print(f"[dim]{traceback.format_exc()}[/dim]")
+def start_session(name=None):
+    """Create a session with an empty history and make it the foreground one"""
+    name = name or str(len(sessions) + 1)
+    if name in sessions:
+        console.print(f"[red]Session {name} already exists[/red]")
+        return
+    if not re.fullmatch(r"[\w-]+", name):
+        console.print("[red]Session names may only contain letters, digits, _ and -[/red]")
+        return
+    session = ChatSession(name, SessionJournal(default_journal_path(name)) if journaling else None)
+    sessions[name] = session
+    switch_session(name)
 
+def switch_session(name):
+    """Bring a session to the foreground and show what it streamed in the background"""
+    global current_session
+    session = sessions.get(name)
+    if session is None:
+        console.print(f"[red]No session named {name}; /session list shows them[/red]")
+        return
+    if session is not current_session:
+        current_session.suspend()
+        session.activate()
+        current_session = session
+    console.print(f"[green]Session {name}: {len(conversation_history)} messages[/green]")
+    follow_session(session)
 
-def save_conversation(filename=None):
-    """Save the conversation history to a file"""
-    if filename is None:
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"conversation_{timestamp}.json"
-    
-    with open(filename, 'w') as f:
-        json.dump(conversation_history, f, indent=2)
-    
-    console.print(f"[green]Conversation saved to {filename}[/green]")
+def display_sessions():
+    """List sessions with their size and streaming state"""
+    table = Table(box=box.SIMPLE, show_edge=False)
+    table.add_column("")
+    table.add_column("Session")
+    table.add_column("Messages", justify="right")
+    table.add_column("State")
+    table.add_column("Journal")
+    for name, session in sessions.items():
+        if session.running:
+            state = f"[cyan]streaming {time.monotonic() - session.started:.0f}s[/cyan]"
+        elif session.error:
+            state = "[red]failed[/red]"
+        else:
+            state = "idle"
+        if session.unseen:
+            state += f" [dim]({session.unseen} unseen events)[/dim]"
+        journal = session.get("journal")
+        table.add_row("*" if session is current_session else "", name, str(len(session.get("conversation_history"))),
+                      state, journal.path if journal else "-")
+    console.print(table)
 
-def load_conversation(filename):
-    """Load a conversation history from a file"""
-    global conversation_history
-    
+def handle_session_command(args):
+    """/session [list] | /session new [name] | /session switch name | /session stop [name]"""
+    action = args[0].lower() if args else "list"
+    if action == "list":
+        display_sessions()
+    elif action == "new":
+        start_session(args[1] if len(args) > 1 else None)
+    elif action == "switch" and len(args) > 1:
+        switch_session(args[1])
+    elif action == "stop":
+        session = sessions.get(args[1]) if len(args) > 1 else current_session
+        if session is None or not session.running:
+            console.print("[yellow]No reply is streaming in that session[/yellow]")
+        else:
+            session.cancel()
+            console.print(f"[green]Stopped session {session.name}[/green]")
+    else:
+        console.print("[red]Usage: /session \\[list] | /session new \\[name] | /session switch name | /session stop \\[name][/red]")
+
+def read_batch_prompts(source):
+    """Yield (id, request) from a JSONL file or '-' for stdin; non-JSON lines are plain prompts"""
+    f = sys.stdin if source == "-" else open(source, "r", encoding="utf-8")
     try:
-        with open(filename, 'r') as f:
-            conversation_history = json.load(f)
-        console.print(f"[green]Loaded conversation from {filename}[/green]")
-        
-        # Display the loaded conversation
-        display_conversation_history()
-    except FileNotFoundError:
-        console.print(f"[red]File not found: {filename}[/red]")
-    except json.JSONDecodeError:
-        console.print(f"[red]Invalid JSON format in file: {filename}[/red]")
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                request = json.loads(line)
+            except json.JSONDecodeError:
+                request = line
+            if not isinstance(request, dict):
+                request = {"prompt": str(request)}
+            yield request.get("id", number), request
+    finally:
+        if f is not sys.stdin:
+            f.close()
 
-def display_conversation_history():
-    """Display the current conversation history"""
-    for message in conversation_history:
-        role = message.get("role", "")
-        content = message.get("content", "")
-        
-        if role == "user":
-            console.print(Panel(content, title="User", border_style="green", box=box.ROUNDED))
-        elif role == "assistant":
-            final_content = Markdown(content)
-            console.print(Panel(final_content, title="Assistant", border_style="violet", box=box.ROUNDED))
-        elif role == "system":
-            console.print(Panel(content, title="System", border_style="yellow", box=box.ROUNDED))
+def run_batch_request(url, request_id, request, temperature, max_tokens, timeout):
+    """Send one batch request through the streaming protocol and return its result record"""
+    messages = request.get("messages")
+    if messages is None:
+        messages = []
+        if request.get("system"):
+            messages.append({"role": "system", "content": request["system"]})
+        messages.append({"role": "user", "content": request.get("prompt", "")})
+    payload = {
+        "messages": messages,
+        "temperature": request.get("temperature", temperature),
+        "max_output_tokens": request.get("max_output_tokens", max_tokens)
+    }
+
+    collector = TurnCollector()
+    metrics = TurnMetrics(url)
+    result = {"id": request_id, "ok": False, "error": None}
+    started = time.perf_counter()
+    response = None
+    endpoint = None
+    timer = None
+    recorded = None
+    try:
+        cache_key, replay = lookup_cached_response(url, messages, payload["temperature"], payload["max_output_tokens"])
+        if replay is not None:
+            batches = [replay.splitlines()]
+            metrics.url = result["endpoint"] = "cache"
+        else:
+            response, endpoint = open_chat_stream(url, None, payload, deadline=started + timeout if timeout else None)
+            metrics.url = result["endpoint"] = endpoint.url
+            if timeout:
+                timer = threading.Timer(max(0.0, timeout - (time.perf_counter() - started)), ChatTransport.abort, (response,))
+                timer.start()
+            batches = get_transport().iter_line_batches(response)
+            recorded = [] if cache_key else None
+        metrics.response_started()
+        result["ttfb"] = round(time.perf_counter() - started, 4)
+        result["cached"] = replay is not None
+        decoder = get_stream_decoder()
+        for lines in batches:
+            if recorded is not None:
+                recorded.extend(lines)
+            for event in decoder.decode_batch(lines):
+                if event.error:
+                    collector.events += 1
+                    continue
+                metrics.event(event)
+                collector.handle(event)
+        result["ok"] = True
+        if recorded is not None:
+            response_cache.put(cache_key, recorded)
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+    finally:
+        if timer is not None:
+            timer.cancel()
+        if response is not None:
+            response.close()
+            get_endpoint_pool(url).finish(endpoint)
+        collector.close()
+
+    elapsed = time.perf_counter() - started
+    if timeout and elapsed >= timeout:
+        result["ok"] = False
+        result["error"] = f"Timeout: request exceeded {timeout}s"
+    result.update({
+        "elapsed": round(elapsed, 4),
+        "response": collector.response,
+        "tool_calls": collector.tool_calls,
+        "messages": collector.messages,
+        "events": collector.events,
+    })
+    metrics.finish()
+    result["metrics"] = metrics.summary()
+    return result
+
+def run_batch(url, source, output, concurrency, temperature, max_tokens, timeout):
+    """
+    Headless batch mode: stream every prompt through the endpoint with a
+    worker pool and write one JSON result per line, in completion order.
+    Returns the process exit code (1 if any request failed).
+    """
+    out = sys.stdout if output == "-" else open(output, "w", encoding="utf-8")
+    done = failed = 0
+    started = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            futures = [
+                pool.submit(run_batch_request, url, request_id, request, temperature, max_tokens, timeout)
+                for request_id, request in read_batch_prompts(source)
+            ]
+            for future in as_completed(futures):
+                result = future.result()
+                done += 1
+                failed += 0 if result["ok"] else 1
+                out.write(json.dumps(result) + "\n")
+                out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    elapsed = time.perf_counter() - started
+    rate = done / elapsed if elapsed else 0.0
+    sys.stderr.write(f"Batch finished: {done} requests, {failed} failed, {elapsed:.1f}s ({rate:.2f} req/s)\n")
+    return 1 if failed else 0
 
 def has_pending_input():
     """Check if there's input waiting in the buffer (indicates paste)"""
@@ -308,45 +3616,94 @@ def has_pending_input():
         pass
     return False
 
-def handle_paste_input(first_line):
-    """Handle detected paste input by collecting all buffered lines"""
-    lines = [first_line]
-    
-    # Collect all remaining lines in buffer
-    while has_pending_input():
-        try:
-            line = input()
-            lines.append(line)
-        except EOFError:
-            break
-        except Exception:
-            break  # Safety break for any unexpected errors
-    
-    # Check for any remaining partial line without newline
+def drain_stdin(until=None, quiet=None):
+    """
+    Read everything waiting on stdin (a terminal) in large reads until no new
+    input arrives for `quiet` seconds, or `until` (bytes) has been read.
+
+    Canonical mode hands out at most one line per read and echoes every
+    line, so the terminal is switched to non-canonical, no-echo mode while
+    draining, when termios is available.
+    """
+    quiet = paste_quiet if quiet is None else quiet
+    fd = sys.stdin.fileno()
+    saved = None
     try:
-        # Read remaining bytes that don't end with newline
-        remaining = os.read(sys.stdin.fileno(), 4096)
-        if remaining:
-            # Decode and add the partial line
-            partial_line = remaining.decode('utf-8', errors='replace').rstrip('\n')
-            if partial_line:  # Only add if there's actual content
-                lines.append(partial_line)
-    except (OSError, BlockingIOError):
-        # If os.read() would block or fails, just continue
-        pass
-    
-    content = "\n".join(lines)
-    console.print(f"[green]📋 Auto-detected multi-line paste ({len(lines)} lines)[/green]")
+        import termios
+        saved = termios.tcgetattr(fd)
+        mode = termios.tcgetattr(fd)
+        mode[3] &= ~(termios.ICANON | termios.ECHO)
+        mode[6][termios.VMIN], mode[6][termios.VTIME] = 1, 0
+        termios.tcsetattr(fd, termios.TCSANOW, mode)
+    except (ImportError, OSError, ValueError):
+        saved = None  # Not a termios terminal: plain reads still work, a line at a time
+
+    chunks = []
+    tail = b""
+    try:
+        while select.select([fd], [], [], quiet)[0]:
+            data = os.read(fd, 1024 * 1024)
+            if not data:
+                break
+            chunks.append(data)
+            if until is not None:
+                if until in tail + data:
+                    break
+                tail = data[-len(until):]
+    finally:
+        if saved is not None:
+            termios.tcsetattr(fd, termios.TCSADRAIN, saved)
+    return b"".join(chunks)
+
+def handle_paste_input(first_line):
+    """Handle detected paste input by draining everything that was pasted"""
+    bracketed = first_line.startswith(PASTE_START)
+    if bracketed and PASTE_END in first_line:
+        rest = b""
+    else:
+        # The end marker can lag behind a large paste, so allow it longer to arrive
+        rest = drain_stdin(PASTE_END.encode() if bracketed else None, 0.5 if bracketed else None)
+    content = first_line + "\n" + rest.decode("utf-8", errors="replace")
+    content = content.replace(PASTE_START, "").replace(PASTE_END, "").replace("\r\n", "\n").rstrip("\n")
+    lines = content.count("\n") + 1
+
+    if len(content) > paste_limit:
+        return offer_paste_attachment(content, lines)
+    console.print(f"[green]📋 Auto-detected multi-line paste ({lines} lines)[/green]")
     return content
 
+def offer_paste_attachment(content, lines):
+    """Ask what to do with an oversized paste: attach a reference, send it inline, or drop it"""
+    size = len(content.encode("utf-8"))
+    console.print(f"[yellow]📋 Pasted {lines} lines ({size / 1024:.0f} KB), over the {paste_limit // 1024} KB paste limit[/yellow]")
+    try:
+        choice = input("│ [a]ttach as a file reference, [s]end inline, or [c]ancel? [a] ").strip().lower() or "a"
+    except (EOFError, KeyboardInterrupt):
+        choice = "c"
+    if choice.startswith("s"):
+        return content
+    if not choice.startswith("a"):
+        console.print("[yellow]Paste discarded[/yellow]")
+        return None
+    try:
+        path = get_blob_store().path(get_blob_store().put(content))
+    except OSError as e:
+        console.print(f"[red]Could not save the paste ({e}), sending it inline[/red]")
+        return content
+    console.print(f"[green]Attached as {path}[/green]")
+    excerpt = excerpt_text(content, context_excerpt_chars, "see the attached file")
+    return f"[Attached paste: {lines} lines, {size} bytes, saved to {path}]\n\n{excerpt}"
+
 def intelligent_input_handler():
     """Main input handler that auto-detects paste vs normal typing"""
     try:
         # Get first line with our custom prompt
         first_line = input("│ ")
         
-        # AUTO-DETECTION: Check for pasted content
-        if has_pending_input():
+        # AUTO-DETECTION: Check for pasted content (bracketed paste markers, or more input already waiting)
+        if first_line.startswith(PASTE_START) or has_pending_input():
+            if PASTE_END in first_line and not has_pending_input():
+                return first_line.replace(PASTE_START, "").replace(PASTE_END, "")
             return handle_paste_input(first_line)
         
         # SINGLE LINE: Normal typed input
@@ -406,12 +3763,30 @@ def print_help():
     /m             - Shortcut for /multiline
     /multiline toggle or /m toggle - Toggle persistent multi-line mode
     /debug         - Print contents of the conversation history variable for debugging
-    /save [file]   - Save conversation to a file (default: conversation_timestamp.json)
-    /load [file]   - Load conversation from a file
-    /history       - Display conversation history
+    /tool \\[N \\[page]] - Page through the full text of tool result N (default: the latest)
+    /profile \\[on|off] - Sample where the client spends its time; writes flame graph stacks per turn
+    /mem           - Show memory held by the conversation history (per role) and the client's caches
+    /save \\[file]   - Save conversation to a file (default: last saved file, or conversation_timestamp.json)
+    /load \\[file]   - Load conversation from a file or a .jsonl session journal
+    /history \\[page] - Display conversation history one page at a time (default: latest page)
+    /history --last N - Display the last N messages
+    /history --search text - Jump to the newest message containing text (repeat for older)
+    /search text   - Search every saved conversation and session journal
+    /session \\[list] - List sessions; /session new \\[name] starts another conversation
+    /session switch name - Bring a session to the foreground, showing what it streamed meanwhile
+    /session stop \\[name] - Stop a session's background reply
+    /bg message    - Send a message and let the reply stream in the background
+    /search show N - Show search result N; /search open N loads its conversation
     /clear         - Clear the conversation history
-    /temp [value]  - Set temperature (0.0-1.0)
-    /tokens [n]    - Set max tokens
+    /temp \\[value]  - Set temperature (0.0-1.0)
+    /tokens \\[n]    - Set max tokens
+    /stats         - Show latency and throughput metrics for the last turn and the session
+    /endpoints     - Show each endpoint's health, load and time to first byte
+    /cache \\[stats|clear] - Show response cache statistics, or empty the cache (needs --cache)
+    /render \\[mode] - Show or set the streaming display: auto, live or plain
+    /context       - Show what the next request will send under the context budget
+    /context budget \\[n] - Set the context token budget (0 = send full history)
+    /context tools \\[policy] - Send stored large tool results in full, as an excerpt, or as a digest
     
     [bold]Input Modes:[/bold]
     • Default: Type and press Enter (single-line)
@@ -420,7 +3795,7 @@ def print_help():
     • /multiline toggle or /m toggle: Persistent multi-line mode
     
     [bold]Smart Features:[/bold]
-    📋 Paste detection - Multi-line content handled automatically
+    📋 Paste detection - Multi-line content handled automatically; huge pastes can be attached as a file
     🔄 Mode switching - /m for quick multi-line access
     🔒 Persistent mode - /m toggle to stay in multi-line mode
     
@@ -449,26 +3824,8 @@ def print_ascii_banner():
 """
     console.print(banner, style="violet")
 
-def main():
-    """Main function to run the CLI client"""
-    parser = argparse.ArgumentParser(description="Qwen Agentic CLI Client")
-    parser.add_argument("--url", default="http://localhost:5001/api/chat",
-                      help="API endpoint URL (default: http://localhost:5001/api/chat)")
-    parser.add_argument("--temp", type=float, default=0.7,
-                      help="Temperature (0.0-1.0, default: 0.7)")
-    parser.add_argument("--tokens", type=int, default=8000,
-                      help="Max tokens (default: 8000)")
-    parser.add_argument("--load", type=str, help="Load conversation from file")
-    args = parser.parse_args()
-
-    #FIXME: DELETE ME    
-    # # Set up signal handling for Ctrl+Q (need to map in terminal)
-    # signal.signal(signal.SIGQUIT, signal_handler)
-    
-    url = args.url
-    temperature = args.temp
-    max_tokens = args.tokens
-
+def print_welcome(url, temperature, max_tokens):
+    """Clear the screen and print the banner and welcome panel"""
     # Clear screen using rich
     console.clear()
 
@@ -482,6 +3839,7 @@ def main():
 - API Endpoint: {url}
 - Temperature: {temperature}
 - Max Tokens: {max_tokens}
+- Journal: {journal.path if journal else 'off'}
 
 [bold yellow]Commands:[/bold yellow]
 - [bold]/help[/bold]           - Show detailed help
@@ -506,27 +3864,331 @@ def main():
         border_style="green",
         expand=False
     ))
+
+class SamplingProfiler:
+    """
+    Low-overhead sampling profiler for the interactive loop.
+
+    A daemon thread wakes every `interval` seconds and records the Python
+    stack of the main thread, and of any other thread that is not parked in
+    a wait (stream workers, asyncio.to_thread renders, background sessions).
+    Samples are aggregated as folded stacks ("thread;outer;...;inner count",
+    the input of flamegraph.pl, speedscope and inferno) and written to one
+    file per turn, where a turn runs from entering a message or command to
+    the next prompt. Time spent waiting at the prompt is not sampled.
+    """
+
+    IDLE_FILES = ("threading.py", os.path.join("concurrent", "futures", "thread.py"), "queue.py")
+
+    def __init__(self, directory, interval=0.005):
+        self.directory = directory
+        self.interval = interval
+        self.prefix = datetime.now().strftime("%Y%m%d_%H%M%S")
+        self.label = "turn"
+        self.turns = 0
+        self.last = None  # (path, samples, seconds, summary rows) of the last turn written
+        self._stacks = {}  # folded stack -> samples in the current turn
+        self._started = time.perf_counter()
+        self._names = {}  # code object -> frame label
+        self._lock = threading.Lock()
+        self._paused = threading.Event()
+        self._stopped = threading.Event()
+        self._main = threading.main_thread().ident
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+
+    def _frame_label(self, code):
+        label = self._names.get(code)
+        if label is None:
+            label = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(";", ",")
+            self._names[code] = label
+        return label
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stopped.wait(self.interval):
+            if self._paused.is_set():
+                continue
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own or (ident != self._main and frame.f_code.co_filename.endswith(self.IDLE_FILES)):
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(self._frame_label(frame.f_code))
+                    frame = frame.f_back
+                stack.append(names.get(ident, "thread").replace(";", ",").replace(" ", "_"))
+                key = ";".join(reversed(stack))
+                with self._lock:
+                    self._stacks[key] = self._stacks.get(key, 0) + 1
+
+    def pause(self):
+        self._paused.set()
+
+    def resume(self, label="turn"):
+        self.label = re.sub(r"\W+", "", label) or "turn"
+        self._started = time.perf_counter()
+        self._paused.clear()
+
+    def finish_turn(self):
+        """Write the current turn's stacks and print its hottest functions"""
+        with self._lock:
+            stacks, self._stacks = self._stacks, {}
+        if not stacks:
+            return
+        self.turns += 1
+        seconds = time.perf_counter() - self._started
+        path = os.path.join(self.directory, f"{self.prefix}_{self.turns:03d}_{self.label}.folded")
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(path, "w", encoding="utf-8") as f:
+                for stack, count in sorted(stacks.items()):
+                    f.write(f"{stack} {count}\n")
+        except OSError as e:
+            console.print(f"[red]Could not write profile: {e}[/red]")
+            path = None
+        samples, rows = summarize_profile(stacks)
+        self.last = (path, samples, seconds, rows)
+        hot = ", ".join(f"{name.split(' (')[0]} {own * 100 // samples}%" for name, own, _ in rows[:3])
+        console.print(f"[dim]Profile: {samples} samples over {seconds:.1f}s; hottest: {hot}"
+                      + (f" -> {path}" if path else "") + "[/dim]")
+
+    def stop(self):
+        # The turn in progress is the /profile off command itself, so its samples are dropped
+        self._stopped.set()
+        self._thread.join()
+
+def summarize_profile(stacks, top=10):
+    """(total samples, [(function, self samples, total samples)]) for the functions with the most self time"""
+    samples = sum(stacks.values())
+    own = {}
+    inclusive = {}
+    for stack, count in stacks.items():
+        frames = stack.split(";")[1:]  # Without the thread name
+        if not frames:
+            continue
+        own[frames[-1]] = own.get(frames[-1], 0) + count
+        for frame in set(frames):
+            inclusive[frame] = inclusive.get(frame, 0) + count
+    hottest = sorted(own.items(), key=lambda item: -item[1])[:top]
+    return samples, [(name, count, inclusive[name]) for name, count in hottest]
+
+def display_profile():
+    """Show whether profiling is on and the hottest functions of the last profiled turn"""
+    if profiler is None:
+        console.print("[yellow]Profiling is off (/profile on or --profile to start it)[/yellow]")
+        return
+    console.print(f"[green]Profiling every {profiler.interval * 1000:.0f} ms; stacks go to {profiler.directory}[/green]")
+    if profiler.last is None:
+        console.print("[dim]No turn profiled yet[/dim]")
+        return
+    path, samples, seconds, rows = profiler.last
+    table = Table(title=f"Last turn: {samples} samples over {seconds:.1f}s", box=box.SIMPLE, show_edge=False)
+    table.add_column("Function")
+    table.add_column("Self %", justify="right")
+    table.add_column("Total %", justify="right")
+    for name, own, total in rows:
+        table.add_row(escape(name), f"{own * 100 / samples:.1f}", f"{total * 100 / samples:.1f}")
+    console.print(table)
+    if path:
+        console.print(f"[dim]Folded stacks: {path} (open in speedscope, or flamegraph.pl {os.path.basename(path)} > flame.svg)[/dim]")
+
+def set_profiling(enabled):
+    global profiler
+    if enabled and profiler is None:
+        profiler = SamplingProfiler(PROFILE_DIR)
+        console.print(f"[green]Profiling on; each turn's stacks are written to {PROFILE_DIR}[/green]")
+    elif not enabled and profiler is not None:
+        profiler.stop()
+        profiler = None
+        console.print("[green]Profiling off[/green]")
+
+def print_startup_profile(marks):
+    """Report the time spent in each startup phase (--profile-startup)"""
+    table = Table(title="Startup profile", box=box.SIMPLE)
+    table.add_column("Phase")
+    table.add_column("ms", justify="right")
+    previous = startup_started
+    for phase, mark in marks:
+        table.add_row(phase, f"{(mark - previous) * 1000:.1f}")
+        previous = mark
+    table.add_row("[bold]Total to first prompt[/bold]", f"[bold]{(previous - startup_started) * 1000:.1f}[/bold]")
+    console.print(table)
+    console.print(f"[dim]CPU time since interpreter start: {time.process_time() * 1000:.1f} ms[/dim]")
+    # Table was only imported for this report, so it does not count
+    loaded = [name for name in DEFERRED_NAMES if name != "Table" and not isinstance(globals()[name], _Deferred)]
+    console.print(f"[dim]Deferred imports loaded before the prompt: {', '.join(loaded) or 'none'}[/dim]")
+
+def main():
+    """Main function to run the CLI client"""
+    parser = argparse.ArgumentParser(description="Qwen Agentic CLI Client")
+    parser.add_argument("--url", default="http://localhost:5001/api/chat",
+                      help="API endpoint URL, or several comma-separated URLs to balance across (default: http://localhost:5001/api/chat)")
+    parser.add_argument("--balance", choices=EndpointPool.STRATEGIES, default="least-outstanding",
+                      help="How to pick an endpoint when --url lists several (default: least-outstanding)")
+    parser.add_argument("--temp", type=float, default=0.7,
+                      help="Temperature (0.0-1.0, default: 0.7)")
+    parser.add_argument("--tokens", type=int, default=8000,
+                      help="Max tokens (default: 8000)")
+    parser.add_argument("--load", type=str, help="Load conversation from file")
+    parser.add_argument("--search", type=str, metavar="TEXT",
+                      help="Search saved conversations and session journals, print the matches and exit")
+    parser.add_argument("--journal", type=str,
+                      help=f"Session journal file (default: a new file under {JOURNAL_DIR})")
+    parser.add_argument("--no-journal", action="store_true",
+                      help="Do not autosave the session to a journal")
+    parser.add_argument("--context-budget", type=int, default=0,
+                      help="Token budget for each request; older tool output and turns are compacted past it (default: 0, off)")
+    parser.add_argument("--paste-limit", type=int, default=256,
+                      help="Pastes over this many KB are offered as an attachment instead of sent inline (default: 256)")
+    parser.add_argument("--cache", action="store_true",
+                      help="Replay responses to repeated requests from a local cache (for demos and regression runs)")
+    parser.add_argument("--cache-size", type=int, default=256,
+                      help="Response cache size limit in MB (default: 256)")
+    parser.add_argument("--cache-entries", type=int, default=1000,
+                      help="Response cache entry limit (default: 1000)")
+    parser.add_argument("--delta", action="store_true",
+                      help="Send only the messages added since the server's last acknowledged prefix (needs server support)")
+    parser.add_argument("--tool-results", choices=TOOL_RESULT_POLICIES, default="full",
+                      help="What to send for tool results stored out of line: full, excerpt or digest (default: full)")
+    parser.add_argument("--connect-timeout", type=float, default=5.0,
+                      help="Seconds allowed to connect to the API (default: 5)")
+    parser.add_argument("--first-byte-timeout", type=float, default=120.0,
+                      help="Seconds to wait for the first streamed data (default: 120)")
+    parser.add_argument("--idle-timeout", type=float, default=300.0,
+                      help="Max seconds between streamed lines, e.g. during long tool runs (default: 300)")
+    parser.add_argument("--async", dest="async_mode", action="store_true",
+                      help="Stream responses through the asyncio pipeline (instant Ctrl+C cancellation)")
+    parser.add_argument("--render", choices=RENDER_MODES, default="auto",
+                      help="Streaming display: live panels, plain text, or auto (live until the terminal falls behind)")
+    parser.add_argument("--compress", choices=("auto", "off") + REQUEST_ENCODINGS, default="auto",
+                      help="Request body compression: auto (when the server advertises it), gzip, zstd or off (default: auto)")
+    parser.add_argument("--no-stream-compression", action="store_true",
+                      help="Ask for the event stream uncompressed (Accept-Encoding: identity)")
+    parser.add_argument("--json-backend", choices=("auto",) + JSON_BACKENDS, default="auto",
+                      help="JSON library for decoding the stream (default: auto, fastest installed)")
+    parser.add_argument("--retries", type=int, default=2,
+                      help="Retries for requests that fail before reaching the server (default: 2)")
+    parser.add_argument("--metrics-file", type=str,
+                      help="Append per-turn latency/throughput metrics to this JSONL file")
+    parser.add_argument("--batch", type=str, metavar="FILE",
+                      help="Headless batch mode: read prompts as JSONL from FILE ('-' for stdin) and exit")
+    parser.add_argument("--output", type=str, default="-",
+                      help="Batch mode: JSONL results file (default: stdout)")
+    parser.add_argument("--concurrency", type=int, default=4,
+                      help="Batch mode: concurrent requests (default: 4)")
+    parser.add_argument("--batch-timeout", type=float, default=600.0,
+                      help="Batch mode: max seconds per request, 0 for none (default: 600)")
+    parser.add_argument("--fast", "--quiet", dest="fast", action="store_true",
+                      help="Fast start: skip the screen clear, banner and welcome panel")
+    parser.add_argument("--profile", action="store_true",
+                      help=f"Profile each turn with a sampling profiler, writing folded stacks to {PROFILE_DIR}")
+    parser.add_argument("--profile-startup", action="store_true",
+                      help="Print where startup time goes up to the first prompt, then exit")
+    args = parser.parse_args()
+    startup_marks = [("Module imports", startup_imported), ("Argument parsing", time.perf_counter())]
+
+    #FIXME: DELETE ME    
+    # # Set up signal handling for Ctrl+Q (need to map in terminal)
+    # signal.signal(signal.SIGQUIT, signal_handler)
+    
+    global transport, async_mode, context_budget, journal, metrics_file, json_backend, render_mode, render_policy
+    global tool_result_policy, delta_session, endpoint_strategy, response_cache, paste_limit, conversation_history
+    conversation_history = MessageStore()
+    paste_limit = max(1, args.paste_limit) * 1024
+    tool_result_policy = args.tool_results
+    if args.cache:
+        response_cache = ResponseCache(CACHE_DIR, max(1, args.cache_size) * 1024 * 1024, max(1, args.cache_entries))
+    endpoint_strategy = args.balance
+    if args.delta:
+        delta_session = DeltaSession()
+    async_mode = args.async_mode
+    render_mode = args.render
+    json_backend = args.json_backend
+    if json_backend != "auto":
+        try:
+            get_stream_decoder()
+        except ImportError:
+            console.print(f"[yellow]{json_backend} is not installed, using the fastest available JSON backend[/yellow]")
+            json_backend = "auto"
+    metrics_file = args.metrics_file
+    context_budget = max(0, args.context_budget)
+    transport = ChatTransport(
+        connect_timeout=args.connect_timeout,
+        first_byte_timeout=args.first_byte_timeout,
+        idle_timeout=args.idle_timeout,
+        retries=args.retries,
+        pool_size=max(4, args.concurrency),
+        compression=args.compress,
+        stream_compression=not args.no_stream_compression
+    )
+    if args.compress not in ("auto", "off") and not encoding_available(args.compress):
+        console.print(f"[yellow]{args.compress} compression needs the zstandard package, using auto[/yellow]")
+        transport.compression = "auto"
+
+    if args.batch:
+        sys.exit(run_batch(args.url, args.batch, args.output, max(1, args.concurrency),
+                           args.temp, args.tokens, args.batch_timeout))
+
+    if args.search:
+        search_conversations(args.search)
+        return
+
+    if not args.no_journal:
+        journal_path = args.journal or default_journal_path()
+        journal = SessionJournal(journal_path)
+
+    url = args.url
+    temperature = args.temp
+    max_tokens = args.tokens
+    startup_marks.append(("Transport and journal setup", time.perf_counter()))
+
+    if args.fast:
+        console.print(f"[dim]Qwen Agentic CLI - {url} - /help for commands[/dim]")
+    else:
+        print_welcome(url, temperature, max_tokens)
+    startup_marks.append(("Banner and welcome", time.perf_counter()))
+
     # Load conversation if specified
     if args.load:
         load_conversation(args.load)
+        startup_marks.append(("Loading conversation", time.perf_counter()))
+
+    if args.profile_startup:
+        print_startup_profile(startup_marks)
+        return
+
+    # Warm the deferred imports in the background while the first message is typed
+    threading.Thread(target=load_deferred_imports, daemon=True).start()
+    if args.profile:
+        set_profiling(True)
     
-    global conversation_history, multiline_mode
+    global multiline_mode, current_session, journaling
+    journaling = not args.no_journal
+    current_session = sessions["main"] = ChatSession("main", journal)
 
     # Main interaction loop
     while True:
         try:
+            if profiler is not None:
+                # The previous turn (message or command) ends here; waiting for input is not profiled
+                profiler.finish_turn()
+                profiler.pause()
             # Show current mode in prompt
+            session_note = f" [dim](session {current_session.name})[/dim]" if len(sessions) > 1 else ""
             if multiline_mode:
-                console.print("\n[bold green]You[/bold green] [dim](multi-line mode)[/dim]")
+                console.print(f"\n[bold green]You[/bold green]{session_note} [dim](multi-line mode)[/dim]")
                 user_input = get_multiline_input()
             else:
-                console.print("\n[bold green]You[/bold green]")
+                console.print(f"\n[bold green]You[/bold green]{session_note}")
                 # Use intelligent input handler that auto-detects paste
                 user_input = intelligent_input_handler()
             
             # Handle cancelled input
             if user_input is None:
                 continue
+            if profiler is not None:
+                profiler.resume(user_input.split()[0] if user_input.startswith("/") else "turn")
             
             # Process commands
             if user_input.startswith("/"):
@@ -535,6 +4197,10 @@ def main():
                 
                 if cmd in ["/quit", "/exit"]:
                     break
+                elif cmd in ("/clear", "/load", "/bg") and current_session.running:
+                    console.print(f"[yellow]Session {current_session.name} is still replying; "
+                                  f"/session switch {current_session.name} to follow it or /session stop[/yellow]")
+                    continue
                 elif cmd in ["/multiline", "/m"]:
                     # Check for toggle sub-command
                     if len(cmd_parts) > 1 and cmd_parts[1].lower() == "toggle":
@@ -554,7 +4220,7 @@ def main():
                 elif cmd == "/debug":
                     console.print("[bold]Current conversation history:[/bold]")
                     for i, msg in enumerate(conversation_history):
-                        console.print(f"[{i}] Role: {msg.get('role', 'unknown')}, Content: {msg.get('content', '')[:50]}...")
+                        console.print(f"[{i}] Role: {msg.get('role', 'unknown')}, Content: {message_preview(msg, 50)}...")
                     continue
                 elif cmd == "/help":
                     print_help()
@@ -569,11 +4235,88 @@ def main():
                     else:
                         console.print("[red]Error: Please specify a file to load[/red]")
                     continue
+                elif cmd == "/stats":
+                    display_stats()
+                    continue
+                elif cmd == "/search":
+                    handle_search_command(cmd_parts[1:])
+                    continue
+                elif cmd == "/endpoints":
+                    display_endpoints(url)
+                    continue
+                elif cmd == "/cache":
+                    action = cmd_parts[1].lower() if len(cmd_parts) > 1 else "stats"
+                    if action == "stats":
+                        display_cache_stats()
+                    elif action == "clear":
+                        if response_cache is None:
+                            display_cache_stats()
+                        else:
+                            console.print(f"[green]Removed {response_cache.clear()} cached responses[/green]")
+                    else:
+                        console.print("[red]Usage: /cache \\[stats|clear][/red]")
+                    continue
+                elif cmd == "/render":
+                    if len(cmd_parts) > 1:
+                        mode = cmd_parts[1].lower()
+                        if mode in RENDER_MODES:
+                            render_policy = RenderPolicy(mode)
+                            console.print(f"[green]Render mode set to {mode}[/green]")
+                        else:
+                            console.print("[red]Render mode must be auto, live or plain[/red]")
+                    else:
+                        console.print(f"[green]{get_render_policy().describe()}[/green]")
+                    continue
+                elif cmd == "/context":
+                    if len(cmd_parts) > 2 and cmd_parts[1].lower() == "budget":
+                        try:
+                            context_budget = max(0, int(cmd_parts[2]))
+                            console.print(f"[green]Context budget set to {context_budget or 'off'}[/green]")
+                        except ValueError:
+                            console.print("[red]Invalid context budget value[/red]")
+                    elif len(cmd_parts) > 1 and cmd_parts[1].lower() == "tools":
+                        if len(cmd_parts) > 2 and cmd_parts[2].lower() in TOOL_RESULT_POLICIES:
+                            tool_result_policy = cmd_parts[2].lower()
+                            console.print(f"[green]Stored tool results will be sent as: {tool_result_policy}[/green]")
+                        else:
+                            console.print(f"[green]Stored tool results are sent as: {tool_result_policy} "
+                                          f"(options: {', '.join(TOOL_RESULT_POLICIES)})[/green]")
+                    else:
+                        display_context_plan()
+                    continue
                 elif cmd == "/history":
-                    display_conversation_history()
+                    handle_history_command(cmd_parts[1:])
+                    continue
+                elif cmd == "/profile":
+                    if len(cmd_parts) > 1 and cmd_parts[1].lower() in ("on", "off"):
+                        set_profiling(cmd_parts[1].lower() == "on")
+                    elif len(cmd_parts) > 1:
+                        console.print("[red]Usage: /profile \\[on|off][/red]")
+                    else:
+                        display_profile()
+                    continue
+                elif cmd == "/tool":
+                    show_tool_result(cmd_parts[1:])
+                    continue
+                elif cmd == "/mem":
+                    display_memory_report()
+                    continue
+                elif cmd == "/session":
+                    handle_session_command(cmd_parts[1:])
+                    continue
+                elif cmd == "/bg":
+                    message = user_input[len(cmd_parts[0]):].strip()
+                    if not message:
+                        console.print("[red]Usage: /bg message[/red]")
+                        continue
+                    record_message({"role": "user", "content": message})
+                    console.print(Padding(Panel(message, title="User", border_style="green", box=box.ROUNDED), (0, 4, 0, 4)))
+                    current_session.start_turn(url, build_request_messages(conversation_history), temperature, max_tokens)
+                    console.print(f"[dim]Replying in the background; /session switch {current_session.name} to follow it[/dim]")
                     continue
                 elif cmd == "/clear":
-                    conversation_history = []
+                    conversation_history = MessageStore()
+                    journal_record({"op": "clear"})
                     console.print("[green]Conversation history cleared[/green]")
                     continue
                 elif cmd == "/temp":
@@ -603,23 +4346,37 @@ def main():
                     console.print("[red]Unknown command. Type /help for available commands.[/red]")
                     continue
             
+            if current_session.running:
+                console.print(f"[yellow]Session {current_session.name} is still replying; "
+                              f"/session switch {current_session.name} to follow it, or /session new for another conversation[/yellow]")
+                continue
+
             # Add user message to history
-            conversation_history.append({"role": "user", "content": user_input})
+            record_message({"role": "user", "content": user_input})
             
-            # Display user message in a panel
+            # Display user message in a panel (only the head and tail of a huge one)
             console.print("")
-            console.print(Padding(Panel(user_input, title="User", border_style="green", box=box.ROUNDED), (0, 4, 0, 4)))
+            shown = excerpt_text(user_input, context_excerpt_chars, "not shown") if len(user_input) > paste_limit else user_input
+            console.print(Padding(Panel(shown, title="User", border_style="green", box=box.ROUNDED), (0, 4, 0, 4)))
             console.print("")
             
             # Process the response
             console.print("")
             console.print("[bold yellow on black]Assistant:[/bold yellow on black]")
-            process_streaming_response(url, conversation_history, temperature, max_tokens)
+            request_messages = build_request_messages(conversation_history)
+            if async_mode:
+                process_streaming_response_async(url, request_messages, temperature, max_tokens)
+            else:
+                process_streaming_response(url, request_messages, temperature, max_tokens)
+            if journal is not None:
+                index_conversation_file(journal.path)
             
         except KeyboardInterrupt:
             console.print("\n[bold red]Interrupted by user. Type /exit to quit.[/bold red]")
         except Exception as e:
             console.print(f"[bold red]Error: {str(e)}[/bold red]")
 
+startup_imported = time.perf_counter()
+
 if __name__ == "__main__":
     main()